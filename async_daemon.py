@@ -0,0 +1,285 @@
+"""
+Pipelined alternative to ``daemon.py``. Messages are downloaded, parsed and
+delivered by separate asyncio stages connected with bounded queues, so the next
+message is downloaded while the previous one is parsed and posted.
+
+imaplib and requests are blocking, so the stages run them in worker threads:
+a single thread owns the (always persistent) IMAP session and up to
+``DELIVERY_CONCURRENCY`` threads post to the webhook.
+"""
+
+import asyncio
+import imaplib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import sentry_sdk
+
+from checkpoint import Checkpoint, checkpoint_key
+from connection import IMAPClient
+from daemon import (
+    apply_actions,
+    batched,
+    claim_batch,
+    defer_action,
+    deferrals,
+    deliver_msg,
+    error_action,
+    fetch_batch,
+    plan_batch,
+    search_mail_ids,
+    serialize_msg,
+    setup,
+    wait_for_mail,
+)
+from delivery import DEFER, WebhookUnavailable, get_breaker
+from executors import get_parse_executor
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    configs, session = setup()
+    try:
+        asyncio.run(serve(configs, session))
+    except Exception as e:
+        if not configs[0]["sentry_dsn"]:
+            raise
+        sentry_sdk.capture_exception(e)
+
+
+async def serve(configs, session):
+    """Run a pipeline per mailbox, all sharing one pool of parse workers."""
+    parser = get_parse_executor(configs[0])
+    try:
+        await asyncio.gather(
+            *(Pipeline(config, session, parser).run() for config in configs)
+        )
+    finally:
+        if parser:
+            parser.shutdown()
+
+
+class Pipeline:
+    def __init__(self, config, session, parser=False):
+        if config["outbox_file"]:
+            # deliveries are not stored, so they would not survive a restart
+            raise Exception("OUTBOX_FILE is not supported by async_daemon.py")
+        self.config = config
+        self.session = session
+        self.client = None
+        self.checkpoint = None
+        if config["checkpoint_file"]:
+            self.checkpoint = Checkpoint(
+                config["checkpoint_file"], checkpoint_key(config)
+            )
+        self.imap_executor = ThreadPoolExecutor(1, thread_name_prefix="imap")
+        self.http_executor = ThreadPoolExecutor(
+            config["delivery_concurrency"], thread_name_prefix="http"
+        )
+        # False makes the pipeline start (and own) a parse executor of its own
+        self.owns_parser = parser is False
+        self.parser = get_parse_executor(config) if self.owns_parser else parser
+        self.parse_queue = None
+        self.first_left = None
+        self.deliver_queue = None
+        # consecutive rounds which failed, to back off retrying the mailbox
+        self.failures = 0
+
+    async def imap(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.imap_executor, func, *args)
+
+    async def run(self):
+        self.parse_queue = asyncio.Queue(self.config["queue_size"])
+        self.deliver_queue = asyncio.Queue(self.config["queue_size"])
+        parse_workers = self.parser.workers if self.parser else 1
+        workers = [
+            asyncio.create_task(self.parse_worker()) for _ in range(parse_workers)
+        ]
+        for _ in range(self.config["delivery_concurrency"]):
+            workers.append(asyncio.create_task(self.deliver_worker()))
+        try:
+            await self.poll()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.imap_executor.shutdown(wait=False)
+            self.http_executor.shutdown(wait=False)
+            if self.parser and self.owns_parser:
+                self.parser.shutdown()
+
+    async def poll(self):
+        """
+        Search and drain the mailbox until cancelled. A failure only backs off
+        this mailbox, the pipelines of the others keep running.
+        """
+        while True:
+            try:
+                await self.poll_once()
+            except Exception as e:
+                await self.fail(e)
+            else:
+                self.failures = 0
+
+    async def poll_once(self):
+        paused = get_breaker(self.config).remaining()
+        if paused:
+            logger.warning(
+                "Webhook unavailable, pausing fetching",
+                extra={"mailbox": self.config["name"], "seconds": paused},
+            )
+            await asyncio.sleep(paused)
+        try:
+            if self.client is None:
+                self.client = await self.imap(IMAPClient, self.config)
+            else:
+                await self.imap(self.client.ensure_connected)
+            msg_ids = await self.imap(search_mail_ids, self.client, self.checkpoint)
+            logger.info(
+                "Found %d mails to download in %s",
+                len(msg_ids),
+                self.config["name"],
+                extra={"mailbox": self.config["name"], "count": len(msg_ids)},
+            )
+            await self.drain(msg_ids)
+            idled = not msg_ids and await self.imap(
+                wait_for_mail, self.client, self.config
+            )
+        except imaplib.IMAP4.abort as e:
+            logger.warning("Connection aborted, going to reconnect: %s", e)
+            await self.imap(self.client.reconnect)
+            return
+        if not msg_ids and not idled:
+            logger.debug("Waiting %d seconds", self.config["delay"])
+            await asyncio.sleep(self.config["delay"])
+            logger.debug("Resume after delay")
+
+    async def fail(self, e):
+        sentry_sdk.capture_exception(e)
+        imap = self.config["imap"]
+        delay = min(
+            imap["reconnect_delay"] * 2**self.failures, imap["reconnect_max_delay"]
+        )
+        self.failures += 1
+        logger.warning(
+            "Mailbox %s failed, retrying in %s seconds: %s",
+            self.config["name"],
+            delay,
+            e,
+            extra={"mailbox": self.config["name"]},
+        )
+        if self.client is not None:
+            await self.imap(self.client.disconnect)
+        self.client = None
+        await asyncio.sleep(delay)
+
+    async def drain(self, msg_ids):
+        # Batches are fed without waiting for the previous one to be delivered,
+        # but finalized in order, so the next SEARCH sees every move applied.
+        finalizer = None
+        self.first_left = None
+        try:
+            for batch in batched(msg_ids, self.config["batch_size"]):
+                claimed = await self.imap(claim_batch, self.client, batch, self.config)
+                self.leave(set(batch) - set(claimed))
+                batch = claimed
+                if not batch:
+                    continue
+                actions, results = await self.feed(batch)
+                finalizer = asyncio.create_task(
+                    self.finalize(finalizer, batch, actions, results)
+                )
+        except BaseException:
+            if finalizer:
+                await asyncio.gather(finalizer, return_exceptions=True)
+            raise
+        if finalizer:
+            await finalizer
+
+    async def feed(self, batch):
+        logger.debug("Fetch batch of %d messages", len(batch))
+        actions = {}
+        sizes = None
+        if self.config["prefetch_sizes"]:
+            batch, sizes = await self.imap(
+                plan_batch, self.client, batch, self.config, actions
+            )
+        messages = fetch_batch(self.client, batch, self.config, sizes)
+        results = []
+        while True:
+            message = await self.imap(next, messages, None)
+            if message is None:
+                return actions, results
+            msg_id, raw_mail = message
+            result = asyncio.get_running_loop().create_future()
+            results.append((msg_id, result))
+            await self.parse_queue.put((msg_id, raw_mail, result))
+
+    async def finalize(self, previous, batch, actions, results):
+        if previous:
+            await previous
+        for msg_id, result in results:
+            action = await result
+            if action != DEFER:
+                deferrals.pop((checkpoint_key(self.config), msg_id), None)
+            if action:
+                actions.setdefault(action, []).append(msg_id)
+        await self.imap(apply_actions, self.client, actions)
+        await self.imap(self.client.expunge)
+        if DEFER in actions:
+            self.leave(actions[DEFER])
+        if self.first_left:
+            # the next SEARCH starts from the first message left in the mailbox
+            batch = [msg_id for msg_id in batch if int(msg_id) < self.first_left]
+        if self.checkpoint:
+            self.checkpoint.advance(batch)
+
+    def leave(self, msg_ids):
+        """
+        Keep the checkpoint below messages left in the mailbox, deferred or
+        claimed by another daemon, so that they are searched again. They do
+        not change the status CONDSTORE compares, so forget the synced status.
+        """
+        if msg_ids:
+            first = min(int(msg_id) for msg_id in msg_ids)
+            self.first_left = min(first, self.first_left or first)
+            self.client.synced_status = {}
+
+    async def parse_worker(self):
+        while True:
+            msg_id, raw_mail, result = await self.parse_queue.get()
+            logger.debug("Process message ID %s", msg_id)
+            try:
+                if self.parser:
+                    task = self.parser.submit(raw_mail)
+                    body = await asyncio.to_thread(task.result)
+                else:
+                    body = await asyncio.to_thread(serialize_msg, raw_mail, self.config)
+            except Exception as e:
+                result.set_result(error_action(e, self.config))
+            else:
+                await self.deliver_queue.put((msg_id, body, result))
+
+    async def deliver_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            msg_id, body, result = await self.deliver_queue.get()
+            try:
+                action = await loop.run_in_executor(
+                    self.http_executor,
+                    deliver_msg,
+                    msg_id,
+                    body,
+                    self.config,
+                    self.session,
+                )
+            except WebhookUnavailable as e:
+                action = defer_action(e, msg_id, self.config)
+            except Exception as e:
+                action = error_action(e, self.config)
+            result.set_result(action)
+
+
+if __name__ == "__main__":
+    main()
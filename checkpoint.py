@@ -0,0 +1,55 @@
+import json
+import os
+
+
+def checkpoint_key(config):
+    imap = config["imap"]
+    key = "{}@{}/{}".format(imap["username"], imap["hostname"], imap["inbox"])
+    if imap["shard_count"] > 1:
+        key += "#{}/{}".format(imap["shard_index"], imap["shard_count"])
+    return key
+
+
+class Checkpoint:
+    """
+    Highest UID already processed in a mailbox, valid for one UIDVALIDITY.
+    Stored in a JSON file shared by all mailboxes, keyed by ``checkpoint_key``.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.uidvalidity = None
+        self.last_uid = 0
+        self.load()
+
+    def _read(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+
+    def load(self):
+        state = self._read().get(self.key, {})
+        self.uidvalidity = state.get("uidvalidity")
+        self.last_uid = state.get("last_uid", 0)
+
+    def save(self):
+        data = self._read()
+        data[self.key] = {"uidvalidity": self.uidvalidity, "last_uid": self.last_uid}
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as fp:
+            json.dump(data, fp)
+        os.replace(tmp_path, self.path)
+
+    def reset(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.last_uid = 0
+        self.save()
+
+    def advance(self, msg_ids):
+        last_uid = max((int(msg_id) for msg_id in msg_ids), default=0)
+        if last_uid > self.last_uid:
+            self.last_uid = last_uid
+            self.save()
@@ -1,4 +1,6 @@
 import imaplib
+import os
+import socket
 from urllib.parse import parse_qs, unquote, urlparse
 
 transports = {"imap": [imaplib.IMAP4, 143], "imap+ssl": [imaplib.IMAP4_SSL, 993]}
@@ -8,12 +10,56 @@ def default_qs(qs, key, default):
     return parse_qs(qs)[key][0] if key in parse_qs(qs) else default
 
 
-def get_config(env):
-    imap_parse = urlparse(env["IMAP_URL"])
-    webhook = env["WEBHOOK_URL"]
+def get_eml_compression(env):
+    if env.get("COMPRESS_EML", "false") != "true":
+        return False
+    codec = env.get("EML_CODEC", "gzip")
+    if codec not in ("gzip", "zstd"):
+        raise Exception("Unknown EML codec", codec)
+    level = env.get("EML_COMPRESSION_LEVEL")
+    skip_ratio = env.get("EML_SKIP_RATIO")
+    return {
+        "codec": codec,
+        "level": int(level) if level else None,
+        "skip_ratio": float(skip_ratio) if skip_ratio else None,
+    }
+
+
+def get_configs(env):
+    """
+    Return one config per mailbox served by the daemon: ``IMAP_URL`` and any
+    number of ``IMAP_URL_<name>``, each posting to ``WEBHOOK_URL_<name>`` or,
+    if that is not set, to ``WEBHOOK_URL``. ``SINK_PATH_<name>`` overrides
+    ``SINK_PATH`` the same way.
+    """
+    names = sorted(
+        key[len("IMAP_URL_") :] for key in env if key.startswith("IMAP_URL_")
+    )
+    suffixes = ([""] if "IMAP_URL" in env else []) + ["_" + name for name in names]
+    if not suffixes:
+        raise KeyError("IMAP_URL")
+    return [get_config(env, suffix) for suffix in suffixes]
+
+
+def get_config(env, suffix=""):
+    imap_parse = urlparse(env["IMAP_URL" + suffix])
+    sink = env.get("SINK", "webhook")
+    if sink not in ("webhook", "directory", "jsonl"):
+        raise Exception("Unknown sink", sink)
+    webhook = env.get("WEBHOOK_URL" + suffix) or env.get("WEBHOOK_URL")
+    if webhook is None and sink == "webhook":
+        raise KeyError("WEBHOOK_URL")
+    sink_path = env.get("SINK_PATH" + suffix) or env.get("SINK_PATH")
+    if sink_path is None and sink != "webhook":
+        raise KeyError("SINK_PATH")
     username = unquote(imap_parse.username) if imap_parse.username else None
     password = unquote(imap_parse.password) if imap_parse.password else None
+    shard_count = max(int(env.get("SHARD_COUNT", 1)), 1)
+    shard_index = int(env.get("SHARD_INDEX", 0))
+    if not 0 <= shard_index < shard_count:
+        raise Exception("SHARD_INDEX must be lower than SHARD_COUNT", shard_index)
     return {
+        "name": suffix[1:] or "default",
         "imap": {
             "hostname": imap_parse.hostname,
             "username": username,
@@ -26,9 +72,61 @@ def get_config(env):
             "on_success": env.get("ON_SUCCESSS", "move"),
             "success": default_qs(imap_parse.query, "success", "SUCCESS"),
             "refused": default_qs(imap_parse.query, "refused", "REFUSED"),
+            "oversize": default_qs(imap_parse.query, "oversize", "OVERSIZE"),
+            "persistent": env.get("PERSISTENT_SESSION", "false") == "true",
+            "reconnect_delay": int(env.get("RECONNECT_DELAY", 1)),
+            "reconnect_max_delay": int(env.get("RECONNECT_MAX_DELAY", 300)),
+            "condstore": env.get("CONDSTORE", "false") == "true",
+            "idle": env.get("IDLE", "false") == "true",
+            # RFC 2177 servers may drop IDLE after 30 minutes, so re-issue it earlier
+            "idle_timeout": min(int(env.get("IDLE_TIMEOUT", 1500)), 29 * 60),
+            "node": env.get("NODE_ID", socket.gethostname()),
+            "claim": env.get("CLAIM_MESSAGES", "false") == "true",
+            "claim_ttl": int(env.get("CLAIM_TTL", 900)),
+            "shard_index": shard_index,
+            "shard_count": shard_count,
         },
         "webhook": webhook,
-        "compress_eml": env.get("COMPRESS_EML", "false") == "true",
+        "sink": sink,
+        "sink_path": sink_path,
+        "http": {
+            "connect_timeout": float(env.get("HTTP_CONNECT_TIMEOUT", 10)),
+            "read_timeout": float(env.get("HTTP_READ_TIMEOUT", 60)),
+            "pool_size": max(int(env.get("HTTP_POOL_SIZE", 10)), 1),
+            "keepalive": env.get("HTTP_KEEPALIVE", "true") == "true",
+            "http2": env.get("HTTP2", "false") == "true",
+            "stream_upload": env.get("STREAM_UPLOAD", "false") == "true",
+        },
+        "compress_eml": get_eml_compression(env),
         "delay": int(env["DELAY"]) if "DELAY" in env else 60,
+        "batch_size": max(int(env.get("BATCH_SIZE", 1)), 1),
+        "spool_threshold": int(env.get("SPOOL_THRESHOLD", 0)),
+        "prefetch_sizes": env.get("PREFETCH_SIZES", "false") == "true",
+        "max_message_size": int(env.get("MAX_MESSAGE_SIZE", 0)),
+        "parse_executor": env.get(
+            "PARSE_EXECUTOR", "process" if env.get("PARSE_WORKERS") else "inline"
+        ),
+        "parse_workers": max(int(env.get("PARSE_WORKERS", os.cpu_count() or 1)), 1),
+        "dedup_url": env.get("DEDUP_URL", None),
+        "dedup_cache_size": max(int(env.get("DEDUP_CACHE_SIZE", 10000)), 0),
+        "delivery_batch_size": max(int(env.get("DELIVERY_BATCH_SIZE", 1)), 1),
+        "delivery_retries": max(int(env.get("DELIVERY_RETRIES", 3)), 0),
+        "max_delivery_attempts": max(int(env.get("MAX_DELIVERY_ATTEMPTS", 10)), 0),
+        "retry_delay": float(env.get("RETRY_DELAY", 1)),
+        "retry_max_delay": float(env.get("RETRY_MAX_DELAY", 60)),
+        "breaker_threshold": max(int(env.get("BREAKER_THRESHOLD", 5)), 1),
+        "breaker_timeout": int(env.get("BREAKER_TIMEOUT", 60)),
+        "delivery_concurrency": max(int(env.get("DELIVERY_CONCURRENCY", 4)), 1),
+        "adaptive_concurrency": env.get("ADAPTIVE_CONCURRENCY", "false") == "true",
+        "target_latency": float(env.get("TARGET_LATENCY", 1)),
+        "queue_size": max(int(env.get("QUEUE_SIZE", 8)), 1),
+        "checkpoint_file": env.get("CHECKPOINT_FILE", None),
+        "outbox_file": env.get("OUTBOX_FILE", None),
+        "outbox_size": max(int(env.get("OUTBOX_SIZE", 1000)), 1),
+        "metrics_port": int(env["METRICS_PORT"]) if "METRICS_PORT" in env else None,
+        "log_level": env.get("LOG_LEVEL", "INFO").upper(),
+        "log_format": env.get("LOG_FORMAT", "json"),
+        "log_rate_limit": float(env.get("LOG_RATE_LIMIT", 10)),
+        "log_queue_size": max(int(env.get("LOG_QUEUE_SIZE", 10000)), 1),
         "sentry_dsn": env.get("SENTRY_DSN", None),
     }
@@ -1,56 +1,507 @@
+import imaplib
+import logging
+import re
+import select
+import ssl
+import time
+from tempfile import SpooledTemporaryFile
+
+from metrics import STAGE_SECONDS
+
+RE_EXISTS = re.compile(rb"^\* \d+ EXISTS", re.I)
+RE_FETCH_UID = re.compile(rb"\bUID (\d+)", re.I)
+FETCH_CHUNK_SIZE = 1024 * 1024
+RE_FETCH_START = re.compile(rb"^\d+ \(")
+RE_FETCH_SIZE = re.compile(rb"\bRFC822\.SIZE (\d+)", re.I)
+RE_STATUS_ITEM = re.compile(rb"([A-Z]+) (\d+)", re.I)
+RE_FETCH_FLAGS = re.compile(rb"\bFLAGS \(([^)]*)\)", re.I)
+RE_FETCH_MODSEQ = re.compile(rb"\bMODSEQ \((\d+)\)", re.I)
+CLAIM_PREFIX = "$ItwClaimed-"
+
+logger = logging.getLogger(__name__)
+
+
+def uid_set(msg_ids):
+    """
+    Build an IMAP sequence set such as ``101:150,152`` from UIDs.
+    Strings are assumed to be ready-made sets and returned as they are.
+    """
+    if isinstance(msg_ids, str):
+        return msg_ids
+    uids = sorted({int(msg_id) for msg_id in msg_ids})
+    ranges = []
+    for uid in uids:
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(
+        str(first) if first == last else "{}:{}".format(first, last)
+        for first, last in ranges
+    )
+
+
+def claim_keyword(node, timestamp):
+    """Keyword marking a message as claimed by ``node`` at ``timestamp``."""
+    return "{}{}-{}".format(CLAIM_PREFIX, claim_node(node), int(timestamp))
+
+
+def claim_node(node):
+    # keywords are IMAP atoms, so keep only characters safe in any of them
+    return re.sub(r"[^A-Za-z0-9_.]", "_", node)
+
+
+def parse_claim(flag):
+    """Return (node, timestamp) of a claim keyword, None for other flags."""
+    if not flag.startswith(CLAIM_PREFIX):
+        return None
+    node, _, timestamp = flag[len(CLAIM_PREFIX) :].rpartition("-")
+    if not timestamp.isdigit():
+        return None
+    return node, int(timestamp)
+
+
+def as_uid_list(msg_ids):
+    return [msg_ids] if isinstance(msg_ids, (str, int)) else list(msg_ids)
+
+
+def iter_fetch_literals(data):
+    """
+    Yield (uid, literal) pairs from an imaplib FETCH response. The UID may be
+    reported before or after the literal, so both parts are inspected.
+    """
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            if pending is not None:
+                yield from _fetch_literal(*pending, b"")
+            pending = item
+        elif pending is not None:
+            yield from _fetch_literal(*pending, item or b"")
+            pending = None
+    if pending is not None:
+        yield from _fetch_literal(*pending, b"")
+
+
+def iter_fetch_responses(data):
+    """
+    Yield the raw bytes of each message in an imaplib FETCH response with
+    literals inlined, e.g. for a BODYSTRUCTURE containing quoted file names.
+    """
+    response = None
+    for item in data:
+        if item is None:
+            continue
+        line = item[0] if isinstance(item, tuple) else item
+        if RE_FETCH_START.match(line) and response is not None:
+            yield response
+            response = None
+        response = (response or b"") + line
+        if isinstance(item, tuple):
+            response += item[1]
+    if response is not None:
+        yield response
+
+
+def _fetch_literal(header, literal, trailer):
+    match = RE_FETCH_UID.search(header) or RE_FETCH_UID.search(trailer)
+    if match:
+        yield match.group(1).decode("ascii"), literal
+
+
 class IMAPClient:
     def __init__(self, config):
-        transport = config["imap"]["transport"]
-        hostname = config["imap"]["hostname"]
-        port = config["imap"]["port"]
+        self.config = config
+        self.client = None
+        # UIDs flagged as deleted by us, kept across reconnects until expunged
+        self.pending_expunge = set()
+        # mailbox status seen by the last SEARCH, compared to detect changes
+        self.synced_status = {}
+        # UIDVALIDITY of the inbox reported by the last SELECT or STATUS
+        self.uidvalidity = None
+        self.connect()
+
+    def connect(self):
+        with STAGE_SECONDS.time(stage="connect"):
+            self._connect()
+
+    def _connect(self):
+        transport = self.config["imap"]["transport"]
+        hostname = self.config["imap"]["hostname"]
+        port = self.config["imap"]["port"]
         self.client = transport(host=hostname, port=port)
-        username = config["imap"]["username"]
-        password = config["imap"]["password"]
-        print(f"Connecting to mail server: {hostname}")
+        username = self.config["imap"]["username"]
+        password = self.config["imap"]["password"]
+        logger.info("Connecting to mail server: %s", hostname)
         if username and password:
             login = self.client.login(username, password)
             if login[0] != "OK":
                 raise Exception("Unable to login", login)
-        print(f"Logged in as {username}")
-        select_folder = self.client.select(config["imap"]["inbox"])
+        logger.info("Logged in as %s", username)
+        self.refresh_capabilities()
+        if self.config["imap"]["idle"] and not self.has_capability("IDLE"):
+            logger.warning("Server does not support IDLE, falling back to polling")
+        if self.qresync:
+            self.client.enable("QRESYNC")
+        self.select()
+
+    def refresh_capabilities(self):
+        # servers commonly advertise extensions (IDLE, MOVE, ...) only after login
+        result_capability, data = self.client.capability()
+        if result_capability != "OK":
+            raise Exception("Unable to fetch capabilities", data)
+        capabilities = tuple(data[-1].decode("ascii").upper().split())
+        self.client.capabilities = capabilities
+        self.capabilities = set(capabilities)
+
+    def has_capability(self, name):
+        return name.upper() in self.capabilities
+
+    @property
+    def condstore(self):
+        return self.config["imap"]["condstore"] and self.has_capability("CONDSTORE")
+
+    @property
+    def qresync(self):
+        return self.condstore and self.has_capability("QRESYNC")
+
+    def select(self):
+        mailbox = self.config["imap"]["inbox"]
+        known = self.synced_status
+        if self.qresync and "HIGHESTMODSEQ" in known:
+            # RFC 7162 quick resynchronization of the previously seen state
+            mailbox = "{} (QRESYNC ({} {}))".format(
+                mailbox, known["UIDVALIDITY"], known["HIGHESTMODSEQ"]
+            )
+        select_folder = self.client.select(mailbox)
         if select_folder[0] != "OK":
             raise Exception("Unable to select folder", select_folder)
+        # Keep the status reported by SELECT to spare a STATUS command.
+        self.selected_status = {}
+        if select_folder[1] and select_folder[1][-1]:
+            self.selected_status["MESSAGES"] = int(select_folder[1][-1])
+        for name in ("UIDVALIDITY", "UIDNEXT", "HIGHESTMODSEQ"):
+            _, data = self.client.response(name)
+            if data and data[-1]:
+                self.selected_status[name] = int(data[-1])
+        self.uidvalidity = self.selected_status.get("UIDVALIDITY")
+
+    def status(self):
+        """
+        Return MESSAGES, UIDVALIDITY, UIDNEXT and, with CONDSTORE, HIGHESTMODSEQ
+        of the inbox, using the SELECT response right after selecting and
+        a STATUS command afterwards.
+        """
+        if "UIDNEXT" in self.selected_status:
+            status, self.selected_status = self.selected_status, {}
+            return status
+        names = "MESSAGES UIDVALIDITY UIDNEXT"
+        if self.condstore:
+            names += " HIGHESTMODSEQ"
+        result_status, data = self.client.status(
+            self.config["imap"]["inbox"], "({})".format(names)
+        )
+        if result_status != "OK":
+            raise Exception("Status failed!", data)
+        items = data[0][data[0].rindex(b"(") :]
+        status = {
+            name.decode("ascii").upper(): int(value)
+            for name, value in RE_STATUS_ITEM.findall(items)
+        }
+        self.uidvalidity = status.get("UIDVALIDITY", self.uidvalidity)
+        return status
+
+    def is_alive(self):
+        try:
+            result_noop, _ = self.client.noop()
+        except (imaplib.IMAP4.abort, OSError) as e:
+            logger.warning("Connection lost: %s", e)
+            return False
+        return result_noop == "OK"
+
+    def ensure_connected(self):
+        # NOOP keeps the session alive and lets the server report new messages,
+        # so the mailbox is re-selected only after the connection was lost.
+        if not self.is_alive():
+            self.reconnect()
+
+    def reconnect(self):
+        delay = self.config["imap"]["reconnect_delay"]
+        while True:
+            try:
+                self.disconnect()
+                self.connect()
+                return
+            except (imaplib.IMAP4.abort, OSError) as e:
+                logger.warning("Unable to reconnect: %s. Retry in %s seconds", e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, self.config["imap"]["reconnect_max_delay"])
+
+    def disconnect(self):
+        if self.client is None:
+            return
+        try:
+            self.client.shutdown()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        self.client = None
+
+    def idle(self, timeout):
+        """
+        Wait in IDLE (RFC 2177) until the server reports a new message or
+        ``timeout`` seconds elapse. Return True if new messages were reported.
+        """
+        tag = self.client._new_tag()
+        self.client.send(tag + b" IDLE\r\n")
+        response = self.client.readline()
+        if not response.startswith(b"+"):
+            raise Exception("IDLE rejected", response)
+        new_mail = False
+        deadline = time.monotonic() + timeout
+        while not new_mail:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self._buffered():
+                readable, _, _ = select.select(
+                    [self.client.socket()], [], [], remaining
+                )
+                if not readable:
+                    break
+            response = self._readline()
+            new_mail = bool(RE_EXISTS.match(response))
+        self.client.send(b"DONE\r\n")
+        # Responses sent before the server noticed DONE still count as wakeups.
+        response = self._readline()
+        while not response.startswith(tag + b" "):
+            new_mail = new_mail or bool(RE_EXISTS.match(response))
+            response = self._readline()
+        self.client.tagged_commands.pop(tag, None)
+        if not response.startswith(tag + b" OK"):
+            raise Exception("IDLE failed", response)
+        return new_mail
 
-    def get_mail_ids(self):
-        result_search, data = self.client.uid("SEARCH", "ALL")
+    def _buffered(self):
+        """
+        Return whether imaplib already holds a response in its read buffer,
+        which select on the socket does not see, peeking without blocking.
+        """
+        sock = self.client.socket()
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return bool(self.client.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def _readline(self):
+        response = self.client.readline()
+        if not response:
+            raise imaplib.IMAP4.abort("connection closed while idling")
+        return response
+
+    def get_mail_ids(self, since_uid=None):
+        if since_uid is None:
+            result_search, data = self.client.uid("SEARCH", "ALL")
+        else:
+            result_search, data = self.client.uid(
+                "SEARCH", "UID", "{}:*".format(since_uid + 1)
+            )
         if result_search != "OK":
             raise Exception("Search failed!")
-        return data[0].decode("utf-8").split()
+        msg_ids = data[0].decode("utf-8").split()
+        if since_uid is not None:
+            # "n:*" also matches the highest UID when it is lower than n
+            msg_ids = [msg_id for msg_id in msg_ids if int(msg_id) > since_uid]
+        return msg_ids
+
+    def fetch_many(self, msg_ids):
+        """
+        Fetch all messages of a UID set (e.g. ``101:150`` or a list of UIDs) with a
+        single UID FETCH and yield (uid, raw_mail) pairs in the server order.
+        Messages expunged in the meantime are silently absent.
+        """
+        result_fetch, data = self.client.uid("FETCH", uid_set(msg_ids), "(UID RFC822)")
+        if result_fetch != "OK":
+            raise Exception("Fetch failed!")
+        yield from iter_fetch_literals(data)
 
-    def fetch(self, msg_id):
-        result_fetch, data = self.client.uid("FETCH", "{0}:{0} RFC822".format(msg_id))
+    def fetch_metadata(self, msg_ids):
+        """
+        Fetch RFC822.SIZE and BODYSTRUCTURE of a UID set in one command and
+        return {uid: {"size": int, "bodystructure": bytes}} for present messages.
+        """
+        result_fetch, data = self.client.uid(
+            "FETCH", uid_set(msg_ids), "(UID RFC822.SIZE BODYSTRUCTURE)"
+        )
         if result_fetch != "OK":
             raise Exception("Fetch failed!")
-        return data[0][1]
+        metadata = {}
+        for response in iter_fetch_responses(data):
+            uid = RE_FETCH_UID.search(response)
+            size = RE_FETCH_SIZE.search(response)
+            if not uid or not size:
+                continue
+            _, _, bodystructure = response.partition(b"BODYSTRUCTURE ")
+            metadata[uid.group(1).decode("ascii")] = {
+                "size": int(size.group(1)),
+                "bodystructure": bodystructure[:-1],
+            }
+        return metadata
+
+    def fetch_flags(self, msg_ids):
+        """Return [(uid, flags, modseq)] of the present messages of a UID set."""
+        result_fetch, data = self.client.uid(
+            "FETCH", uid_set(msg_ids), "(UID FLAGS MODSEQ)"
+        )
+        if result_fetch != "OK":
+            raise Exception("Fetch failed!")
+        messages = []
+        for response in iter_fetch_responses(data):
+            uid = RE_FETCH_UID.search(response)
+            flags = RE_FETCH_FLAGS.search(response)
+            modseq = RE_FETCH_MODSEQ.search(response)
+            if not uid or not flags or not modseq:
+                continue
+            messages.append(
+                (
+                    uid.group(1).decode("ascii"),
+                    flags.group(1).decode("ascii").split(),
+                    int(modseq.group(1)),
+                )
+            )
+        return messages
+
+    def claim(self, msg_ids, node, ttl):
+        """
+        Claim messages for ``node`` with a keyword holding the claim time,
+        skipping messages claimed by another node less than ``ttl`` seconds ago.
+        The keyword is set with a conditional STORE (RFC 7162 UNCHANGEDSINCE),
+        so of two daemons claiming a message at once only the first succeeds.
+        Return the claimed UIDs.
+        """
+        if not self.has_capability("CONDSTORE"):
+            raise Exception("Claiming messages requires a server supporting CONDSTORE")
+        now = time.time()
+        keyword = claim_keyword(node, now)
+        claimed = []
+        for uid, flags, modseq in self.fetch_flags(msg_ids):
+            claims = {flag: parse_claim(flag) for flag in flags if parse_claim(flag)}
+            if any(
+                owner != claim_node(node) and timestamp + ttl > now
+                for owner, timestamp in claims.values()
+            ):
+                continue
+            self.client.response("MODIFIED")
+            store_result, data = self.client.uid(
+                "STORE",
+                uid,
+                "(UNCHANGEDSINCE {})".format(modseq),
+                "+FLAGS.SILENT",
+                "({})".format(keyword),
+            )
+            _, modified = self.client.response("MODIFIED")
+            if store_result != "OK":
+                # e.g. the server's limit of keywords per mailbox is reached
+                raise Exception("Unable to claim msg {}".format(uid), data)
+            if modified[-1]:
+                continue
+            # drop expired claims of crashed nodes and our own older claim
+            stale = [flag for flag in claims if flag != keyword]
+            if stale:
+                self.client.uid(
+                    "STORE", uid, "-FLAGS.SILENT", "({})".format(" ".join(stale))
+                )
+            claimed.append(uid)
+        return claimed
+
+    def unclaim(self, msg_ids, node):
+        """
+        Remove the claim keywords of ``node`` from messages, so that they are
+        not carried into other folders and do not pile up in the keywords the
+        server tracks per mailbox.
+        """
+        keywords = {}
+        for uid, flags, _ in self.fetch_flags(msg_ids):
+            for flag in flags:
+                claim = parse_claim(flag)
+                if claim and claim[0] == claim_node(node):
+                    keywords.setdefault(flag, []).append(uid)
+        for keyword, uids in keywords.items():
+            self.client.uid(
+                "STORE", uid_set(uids), "-FLAGS.SILENT", "({})".format(keyword)
+            )
+
+    def fetch_spooled(self, msg_id, spool_threshold, chunk_size=FETCH_CHUNK_SIZE):
+        """
+        Download a message in partial BODY[] chunks into a temporary file kept in
+        memory up to ``spool_threshold`` bytes, so that no more than one chunk is
+        held in memory for large messages. Return None if the message is gone.
+        """
+        spool = SpooledTemporaryFile(max_size=spool_threshold)
+        offset = 0
+        while True:
+            result_fetch, data = self.client.uid(
+                "FETCH", msg_id, "(UID BODY[]<{}.{}>)".format(offset, chunk_size)
+            )
+            if result_fetch != "OK":
+                spool.close()
+                raise Exception("Fetch failed!")
+            chunk = next((literal for _, literal in iter_fetch_literals(data)), None)
+            if chunk is None and offset == 0:
+                spool.close()
+                return None
+            spool.write(chunk or b"")
+            offset += len(chunk or b"")
+            if not chunk or len(chunk) < chunk_size:
+                break
+        spool.seek(0)
+        return spool
 
     def connection_close(self):
         self.client.close()
-        print("Connection closed")
+        logger.debug("Connection closed")
         self.client.logout()
-        print("Logged out")
+        logger.debug("Logged out")
 
-    def move(self, msg_id, folder):
-        print("Going to move {} to {}".format(msg_id, folder))
-        self.copy(folder, msg_id)
-        self.mark_delete(msg_id)
+    def move(self, msg_ids, folder):
+        msg_ids = as_uid_list(msg_ids)
+        logger.info("Going to move %s to %s", uid_set(msg_ids), folder)
+        if self.has_capability("MOVE"):
+            move_result, data = self.client.uid("MOVE", uid_set(msg_ids), folder)
+            if move_result != "OK":
+                logger.warning("MOVE failed: %s %s", move_result, data)
+                raise Exception("Failed to move msg {} to {}".format(msg_ids, folder))
+            return
+        self.copy(folder, msg_ids)
+        self.mark_delete(msg_ids)
 
-    def mark_delete(self, msg_id):
-        print("Going to mark as deleted {}".format(msg_id))
-        delete_result, _ = self.client.uid("STORE", msg_id, "+FLAGS", r"(\Deleted)")
+    def mark_delete(self, msg_ids):
+        msg_ids = as_uid_list(msg_ids)
+        logger.info("Going to mark as deleted %s", uid_set(msg_ids))
+        delete_result, _ = self.client.uid(
+            "STORE", uid_set(msg_ids), "+FLAGS", r"(\Deleted)"
+        )
         if delete_result != "OK":
-            raise Exception("Failed to mark as deleted msg {}".format(msg_id))
+            raise Exception("Failed to mark as deleted msg {}".format(msg_ids))
+        self.pending_expunge.update(msg_ids)
 
-    def copy(self, folder, msg_id):
-        print("Going to copy {} to {}".format(msg_id, folder))
-        copy_result, data = self.client.uid("COPY", msg_id, folder)
+    def copy(self, folder, msg_ids):
+        msg_ids = as_uid_list(msg_ids)
+        logger.debug("Going to copy %s to %s", uid_set(msg_ids), folder)
+        copy_result, data = self.client.uid("COPY", uid_set(msg_ids), folder)
         if copy_result != "OK":
-            print(copy_result, data)
-            raise Exception("Failed to copy msg {} to {}".format(msg_id, folder))
+            logger.warning("COPY failed: %s %s", copy_result, data)
+            raise Exception("Failed to copy msg {} to {}".format(msg_ids, folder))
 
     def expunge(self):
-        self.client.expunge()
+        # With UIDPLUS only the messages deleted by us are expunged, leaving
+        # messages flagged by other clients untouched.
+        if self.has_capability("UIDPLUS"):
+            if self.pending_expunge:
+                self.client.uid("EXPUNGE", uid_set(self.pending_expunge))
+        else:
+            self.client.expunge()
+        self.pending_expunge = set()
@@ -1,96 +1,802 @@
 import copy
+import imaplib
+import itertools
+import logging
 import os
+import threading
 import time
 
-import requests
 import sentry_sdk
 
-from config import get_config
-from connection import IMAPClient
-from mail_parser import serialize_mail
+from checkpoint import Checkpoint, checkpoint_key
+from config import get_configs
+from connection import IMAPClient, uid_set
+from dedup import get_dedup
+from delivery import (
+    DEFER,
+    CircuitOpen,
+    WebhookUnavailable,
+    get_breaker,
+    new_session,
+    post_webhook,
+)
+from executors import get_parse_executor
+from logs import setup_logging
+from mail_parser import combine_mails, serialize_mail
+from metrics import (
+    BACKLOG,
+    BYTES,
+    MESSAGES,
+    STAGE_SECONDS,
+    observe_stages,
+    start_server,
+)
+from outbox import Outbox
+from sinks import get_sink
 from version import __version__
 
+logger = logging.getLogger(__name__)
+
+# failed deliveries of messages left in the mailbox, by checkpoint_key and UID
+deferrals = {}
+
+
+def setup():
+    configs = get_configs(os.environ)
+    session = new_session(configs[0])
+    setup_logging(configs[0])
+    logger.info("Starting daemon version %s", __version__)
+    for config in configs:
+        config_printout = copy.deepcopy(config)
+        if "password" in config_printout.get("imap", {}):
+            config_printout["imap"]["password"] = "********"
+        logger.info("Configuration: %s", config_printout)
+    sentry_sdk.init(dsn=configs[0]["sentry_dsn"], traces_sample_rate=1.0)
+    if configs[0]["metrics_port"]:
+        start_server(configs[0]["metrics_port"])
+    return configs, session
+
 
 def main():
-    config = get_config(os.environ)
-    config_printout = copy.deepcopy(config)
-    if "password" in config_printout.get("imap", {}):
-        config_printout["imap"]["password"] = "********"
-
-    session = requests.Session()
-    print(f"Starting daemon version {__version__}")
-    print("Configuration: ", config_printout)
-    sentry_sdk.init(dsn=config["sentry_dsn"], traces_sample_rate=1.0)
-    if config["sentry_dsn"]:
+    configs, session = setup()
+    if configs[0]["sentry_dsn"]:
         try:
-            loop(config, session)
+            serve(configs, session)
         except Exception as e:
             sentry_sdk.capture_exception(e)
     else:
-        loop(config, session, None)
+        serve(configs, session, None)
 
 
 def loop(config, session, sentry_client=None):
+    serve([config], session, sentry_client)
+
+
+def serve(configs, session, sentry_client=None):
+    """
+    Serve all mailboxes from one process. Every round gives each mailbox at
+    most one batch, so a busy mailbox can not starve the others.
+    """
+    parser = get_parse_executor(configs[0])
+    idle = len(configs) == 1
+    mailboxes = [
+        Mailbox(config, session, sentry_client, parser, idle) for config in configs
+    ]
     while True:
-        client = IMAPClient(config)
-        msg_ids = client.get_mail_ids()
-        print("Found {} mails to download".format(len(msg_ids)))
-        print("Identified following msg id", msg_ids)
-        any_message = bool(msg_ids)
+        busy = False
+        for mailbox in mailboxes:
+            busy = mailbox.step() or busy
+        if busy:
+            continue
+        if idle and mailboxes[0].wait():
+            continue
+        due = min(mailbox.next_poll for mailbox in mailboxes)
+        delay = max(due - time.monotonic(), 0)
+        logger.debug("Waiting %d seconds", round(delay))
+        time.sleep(delay)
+        logger.debug("Resume after delay")
+        for mailbox in mailboxes:
+            if mailbox.next_poll <= due:
+                mailbox.next_poll = 0
+
+
+class Mailbox:
+    """
+    State of one served mailbox: its IMAP session, checkpoint, outbox and the
+    UIDs of the last SEARCH which are still to be processed.
+    """
+
+    def __init__(self, config, session, sentry_client=None, parser=None, idle=True):
+        self.config = config
+        self.session = session
+        self.sentry_client = sentry_client
+        self.parser = parser
+        # IDLE blocks on a single connection, so it is used only by a daemon
+        # serving one mailbox
+        self.idle = idle
+        self.persistent = config["imap"]["persistent"]
+        self.checkpoint = None
+        if config["checkpoint_file"]:
+            self.checkpoint = Checkpoint(
+                config["checkpoint_file"], checkpoint_key(config)
+            )
+        self.outbox = None
+        if config["outbox_file"]:
+            self.outbox = Outbox(config["outbox_file"], checkpoint_key(config))
+            threading.Thread(
+                target=deliver_outbox,
+                args=(self.outbox, config, session),
+                name="deliver-{}".format(config["name"]),
+                daemon=True,
+            ).start()
+        self.client = None
+        self.msg_ids = []
+        # first UID of the SEARCH result left in the mailbox, deferred or
+        # claimed by another daemon, which the checkpoint must not pass
+        self.first_left = None
+        self.next_poll = 0
+        # consecutive steps which failed, to back off retrying the mailbox
+        self.failures = 0
+
+    def step(self):
+        """
+        Process the next batch, searching the mailbox first once the previous
+        SEARCH result is drained. Return whether any work was done. A failure
+        only backs off this mailbox, the others keep being served.
+        """
+        try:
+            busy = self._step()
+        except Exception as e:
+            self.fail(e)
+            return False
+        self.failures = 0
+        return busy
+
+    def _step(self):
+        if not self.msg_ids and time.monotonic() < self.next_poll:
+            return False
+        # the outbox keeps fetching while the webhook is down
+        paused = not self.outbox and get_breaker(self.config).remaining()
+        if paused:
+            logger.warning(
+                "Webhook unavailable, pausing fetching",
+                extra={"mailbox": self.config["name"], "seconds": paused},
+            )
+            self.next_poll = time.monotonic() + paused
+            self.release()
+            return False
+        try:
+            if self.client is None:
+                self.client = IMAPClient(self.config)
+            elif not self.msg_ids:
+                self.client.ensure_connected()
+            if self.outbox:
+                settle_outbox(self.client, self.outbox)
+            if not self.msg_ids:
+                self.search()
+            if not self.msg_ids:
+                self.next_poll = time.monotonic() + self.config["delay"]
+                if not self.idle:
+                    self.release()
+                return False
+            if self.outbox and self.outbox.backlog() >= self.config["outbox_size"]:
+                logger.warning(
+                    "Outbox is full, waiting for deliveries",
+                    extra={"mailbox": self.config["name"]},
+                )
+                self.next_poll = time.monotonic() + self.config["delay"]
+                self.release()
+                return False
+            batch = self.process_next()
+            BACKLOG.set(len(self.msg_ids), mailbox=self.config["name"])
+        except imaplib.IMAP4.abort as e:
+            self.abort(e)
+            return True
+        # Without a persistent session, reconnect once per batch rather than
+        # once per message.
+        self.release()
+        if not batch and not self.msg_ids:
+            # every message left is claimed by another daemon or deferred
+            self.next_poll = time.monotonic() + self.config["delay"]
+            return False
+        return True
+
+    def process_next(self):
+        """Process the next batch of the SEARCH result, return the UIDs done."""
+        batch = self.msg_ids[: self.config["batch_size"]]
+        del self.msg_ids[: self.config["batch_size"]]
+        claimed = claim_batch(self.client, batch, self.config)
+        # another daemon may crash before its claim expires, so its messages
+        # must be searched again
+        self.leave(set(batch) - set(claimed))
+        batch = claimed
+        deferred = []
+        if batch:
+            deferred = process_batch(
+                self.client,
+                batch,
+                self.config,
+                self.session,
+                self.sentry_client,
+                self.parser,
+                self.outbox,
+            )
+        if deferred:
+            # search again once the webhook is back, starting from the first
+            # message left in the mailbox
+            self.msg_ids = []
+            self.leave(deferred)
+        if self.first_left:
+            batch = [msg_id for msg_id in batch if int(msg_id) < self.first_left]
+        if self.checkpoint:
+            self.checkpoint.advance(batch)
+        return batch
+
+    def leave(self, msg_ids):
+        """
+        Keep the checkpoint below messages left in the mailbox. Leaving them
+        there changes nothing CONDSTORE would notice, so forget the synced
+        status for the next SEARCH to find them again.
+        """
         if msg_ids:
-            process_msg(client, msg_ids[0], config, session, sentry_client)
-        client.expunge()
-        client.connection_close()
-        if not any_message:
-            print("Waiting {} seconds".format(config["delay"]))
-            time.sleep(config["delay"])
-            print("Resume after delay")
+            first = min(int(msg_id) for msg_id in msg_ids)
+            self.first_left = min(first, self.first_left or first)
+            self.client.synced_status = {}
 
+    def search(self):
+        self.first_left = None
+        self.msg_ids = search_mail_ids(self.client, self.checkpoint)
+        if self.outbox:
+            # parsed before a restart, only waiting for delivery
+            known = self.outbox.known(self.msg_ids)
+            self.msg_ids = [msg_id for msg_id in self.msg_ids if msg_id not in known]
+        logger.info(
+            "Found %d mails to download in %s",
+            len(self.msg_ids),
+            self.config["name"],
+            extra={"mailbox": self.config["name"], "count": len(self.msg_ids)},
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Identified following msg id %s", uid_set(self.msg_ids))
 
-def process_msg(client, msg_id, config, session, sentry_client=None):
-    print("Fetch message ID {}".format(msg_id))
-    start = time.time()
-    raw_mail = client.fetch(msg_id)
-    end = time.time()
-    print("Message downloaded in {} seconds".format(end - start))
+    def wait(self):
+        """Wait for new mail with IDLE, return False if it is not available."""
+        idled = False
+        if self.outbox and self.outbox.backlog():
+            # poll to apply the outcome of deliveries in progress
+            self.release()
+            return False
+        if self.first_left or get_breaker(self.config).remaining():
+            # retry messages left in the mailbox after DELAY or BREAKER_TIMEOUT
+            # rather than when new mail arrives
+            self.release()
+            return False
+        try:
+            idled = self.client is not None and wait_for_mail(self.client, self.config)
+        except imaplib.IMAP4.abort as e:
+            self.abort(e)
+            idled = True
+        self.release()
+        if idled:
+            self.next_poll = 0
+        return idled
 
-    try:
+    def fail(self, e):
+        sentry_sdk.capture_exception(e)
+        imap = self.config["imap"]
+        delay = min(
+            imap["reconnect_delay"] * 2**self.failures, imap["reconnect_max_delay"]
+        )
+        self.failures += 1
+        logger.warning(
+            "Mailbox %s failed, retrying in %s seconds: %s",
+            self.config["name"],
+            delay,
+            e,
+            extra={"mailbox": self.config["name"]},
+        )
+        if self.client is not None:
+            self.client.disconnect()
+        self.client = None
+        self.msg_ids = []
+        self.next_poll = time.monotonic() + delay
+
+    def abort(self, e):
+        if not self.persistent:
+            raise
+        logger.warning("Connection aborted, going to reconnect: %s", e)
+        self.msg_ids = []
+        self.client.reconnect()
+
+    def release(self):
+        if not self.persistent and self.client is not None:
+            self.client.connection_close()
+            self.client = None
+
+
+def search_mail_ids(client, checkpoint=None):
+    msg_ids = shard_ids(_search_mail_ids(client, checkpoint), client.config)
+    BACKLOG.set(len(msg_ids), mailbox=client.config["name"])
+    return msg_ids
+
+
+def shard_ids(msg_ids, config):
+    """
+    Keep the UIDs of this daemon's shard, so that SHARD_COUNT daemons serving
+    the same mailbox split its messages without talking to each other.
+    """
+    shard_index = config["imap"]["shard_index"]
+    shard_count = config["imap"]["shard_count"]
+    return [msg_id for msg_id in msg_ids if int(msg_id) % shard_count == shard_index]
+
+
+def claim_batch(client, batch, config):
+    """Return the UIDs of a batch claimed for this daemon."""
+    if not config["imap"]["claim"] or not batch:
+        return batch
+    claimed = client.claim(batch, config["imap"]["node"], config["imap"]["claim_ttl"])
+    if len(claimed) < len(batch):
+        logger.info(
+            "Skip %d messages claimed by other daemons", len(batch) - len(claimed)
+        )
+    return claimed
+
+
+def _search_mail_ids(client, checkpoint=None):
+    if checkpoint is None and not client.condstore:
+        return client.get_mail_ids()
+    status = client.status()
+    if client.condstore:
+        # Unchanged HIGHESTMODSEQ, UIDNEXT and message count mean the SEARCH
+        # would return the same result as the previous one.
+        if status == client.synced_status:
+            return []
+        client.synced_status = status
+    if checkpoint is None:
+        return client.get_mail_ids()
+    if status.get("UIDVALIDITY") != checkpoint.uidvalidity:
+        logger.warning("UIDVALIDITY changed, going to rescan the whole mailbox")
+        checkpoint.reset(status.get("UIDVALIDITY"))
+    elif status.get("UIDNEXT", 0) and status["UIDNEXT"] <= checkpoint.last_uid + 1:
+        return []
+    return client.get_mail_ids(checkpoint.last_uid)
+
+
+def wait_for_mail(client, config):
+    if not config["imap"]["idle"] or not client.has_capability("IDLE"):
+        return False
+    logger.debug("Waiting for new mail using IDLE")
+    if client.idle(config["imap"]["idle_timeout"]):
+        logger.debug("Server reported new mail")
+    return True
+
+
+def batched(items, size):
+    items = iter(items)
+    while batch := list(itertools.islice(items, size)):
+        yield batch
+
+
+def plan_batch(client, msg_ids, config, actions):
+    """
+    Fetch the sizes of a batch in one command, route oversize messages to
+    the oversize folder without downloading them and order the rest from
+    the smallest. Return the planned UIDs and their sizes.
+    """
+    metadata = client.fetch_metadata(msg_ids)
+    sizes = {msg_id: item["size"] for msg_id, item in metadata.items()}
+    max_size = config["max_message_size"]
+    planned = []
+    for msg_id in sorted(sizes, key=sizes.get):
+        if max_size and sizes[msg_id] > max_size:
+            logger.warning(
+                "Message ID %s exceeds %d bytes (%d bytes)",
+                msg_id,
+                max_size,
+                sizes[msg_id],
+                extra={"msg_id": msg_id, "size": sizes[msg_id]},
+            )
+            actions.setdefault(("move", config["imap"]["oversize"]), []).append(msg_id)
+        else:
+            planned.append(msg_id)
+    return planned, sizes
+
+
+def fetch_batch(client, msg_ids, config, sizes=None):
+    threshold = config["spool_threshold"]
+    if not threshold:
+        small, large = msg_ids, []
+    elif sizes is None:
+        small, large = [], msg_ids
+    else:
+        small = [msg_id for msg_id in msg_ids if sizes[msg_id] <= threshold]
+        large = [msg_id for msg_id in msg_ids if sizes[msg_id] > threshold]
+    if small:
         start = time.time()
-        body = serialize_mail(raw_mail, config["compress_eml"])
+        messages = list(client.fetch_many(small))
         end = time.time()
-        print("Message serialized in {} seconds".format(end - start))
-        res = session.post(config["webhook"], files=body)
-        print("Received response:", res.text)
-        # detect structured refusal and move to REFUSED folder
-        if res.status_code >= 400:
-            refused_folder = config["imap"].get("refused", "REFUSED")
-            # parse JSON refusal marker
-            payload = None
+        STAGE_SECONDS.observe(end - start, stage="fetch")
+        BYTES.inc(sum(len(raw_mail) for _, raw_mail in messages), direction="in")
+        logger.debug(
+            "Batch downloaded in %.3f seconds",
+            end - start,
+            extra={"count": len(messages), "seconds": end - start},
+        )
+        if len(messages) < len(small):
+            logger.info("%d messages no longer exist", len(small) - len(messages))
+        # keep the planned order rather than the order returned by the server
+        order = {msg_id: i for i, msg_id in enumerate(small)}
+        messages.sort(key=lambda message: order[message[0]])
+        yield from messages
+    # Download large messages one at a time into temporary files to bound memory.
+    for msg_id in large:
+        start = time.time()
+        raw_mail = client.fetch_spooled(msg_id, threshold)
+        end = time.time()
+        if raw_mail is None:
+            logger.info("Message ID %s no longer exists", msg_id)
+            continue
+        STAGE_SECONDS.observe(end - start, stage="fetch")
+        BYTES.inc(raw_mail.seek(0, os.SEEK_END), direction="in")
+        raw_mail.seek(0)
+        logger.debug(
+            "Message downloaded in %.3f seconds",
+            end - start,
+            extra={"msg_id": msg_id, "seconds": end - start},
+        )
+        yield msg_id, raw_mail
+
+
+def process_batch(
+    client, msg_ids, config, session, sentry_client=None, parser=None, outbox=None
+):
+    """
+    Download, parse and deliver a batch, then apply the resulting actions.
+    Return the UIDs left in the mailbox because the webhook was unavailable.
+    """
+    logger.debug("Fetch batch of %d messages", len(msg_ids))
+    # Group UIDs by destination so that each folder costs one command per batch.
+    actions = {}
+    sizes = None
+    if config["prefetch_sizes"]:
+        msg_ids, sizes = plan_batch(client, msg_ids, config, actions)
+    messages = fetch_batch(client, msg_ids, config, sizes)
+    if parser:
+        messages = parser.parse_ahead(messages)
+    # Messages are delivered in fetch order, even when parsed by workers.
+    for msg_id, action in deliver_batch(
+        client, messages, config, session, sentry_client, outbox
+    ):
+        if action != DEFER:
+            deferrals.pop((checkpoint_key(config), msg_id), None)
+        if action:
+            actions.setdefault(action, []).append(msg_id)
+    apply_actions(client, actions)
+    client.expunge()
+    return actions.get(DEFER, [])
+
+
+def deliver_batch(client, messages, config, session, sentry_client=None, outbox=None):
+    """Yield (msg_id, action) for fetched messages as they are delivered."""
+    if outbox:
+        for msg_id, raw_mail, *parsed in messages:
+            yield msg_id, queue_msg(client, outbox, msg_id, raw_mail, config, *parsed)
+    elif config["delivery_batch_size"] > 1 and not get_sink(config):
+        for chunk in batched(messages, config["delivery_batch_size"]):
+            yield from process_msgs(chunk, config, session)
+    else:
+        for msg_id, raw_mail, *parsed in messages:
+            yield msg_id, process_msg(
+                client, msg_id, raw_mail, config, session, sentry_client, *parsed
+            )
+
+
+def apply_actions(client, actions):
+    imap = client.config["imap"]
+    if imap["claim"] and actions:
+        # the claim keyword would be moved along with the messages
+        msg_ids = [msg_id for msg_ids in actions.values() for msg_id in msg_ids]
+        client.unclaim(msg_ids, imap["node"])
+    for (action, folder), msg_ids in actions.items():
+        if action == "move":
+            with STAGE_SECONDS.time(stage="move"):
+                client.move(msg_ids, folder)
+        elif action == "delete":
+            client.mark_delete(msg_ids)
+
+
+def process_msg(
+    client, msg_id, raw_mail, config, session, sentry_client=None, parsed=None
+):
+    """
+    Deliver a message to the webhook and return the action to apply to it:
+    ("move", folder), ("delete", None) or None to leave it in place.
+    ``parsed`` is a pending ParseTask when the message is parsed by a worker.
+    """
+    logger.debug("Process message ID %s", msg_id)
+    try:
+        body = parsed.result() if parsed else serialize_msg(raw_mail, config)
+        return deliver_msg(msg_id, body, config, session)
+    except WebhookUnavailable as e:
+        return defer_action(e, msg_id, config)
+    except Exception as e:
+        return error_action(e, config)
+
+
+def process_msgs(messages, config, session):
+    """
+    Deliver several messages in one request and return [(msg_id, action)]
+    for the status the webhook reported for each of them.
+    """
+    bodies = []
+    results = []
+    for msg_id, raw_mail, *parsed in messages:
+        logger.debug("Process message ID %s", msg_id)
+        try:
+            body = parsed[0].result() if parsed else serialize_msg(raw_mail, config)
+        except Exception as e:
+            results.append((msg_id, error_action(e, config)))
+        else:
+            bodies.append((msg_id, body))
+    if not bodies:
+        return results
+    try:
+        return results + deliver_msgs(bodies, config, session)
+    except WebhookUnavailable as e:
+        return results + [
+            (msg_id, defer_action(e, msg_id, config)) for msg_id, _ in bodies
+        ]
+    except Exception as e:
+        action = error_action(e, config)
+        return results + [(msg_id, action) for msg_id, _ in bodies]
+
+
+def queue_msg(client, outbox, msg_id, raw_mail, config, parsed=None):
+    """
+    Store a parsed message in the outbox for delivery, returning the error
+    action if it can not be parsed and None otherwise.
+    """
+    logger.debug("Queue message ID %s", msg_id)
+    try:
+        body = parsed.result() if parsed else serialize_msg(raw_mail, config)
+    except Exception as e:
+        return error_action(e, config)
+    outbox.add(msg_id, body, client.uidvalidity)
+
+
+def deliver_outbox(outbox, config, session):
+    """Deliver messages added to the outbox, retrying failures after DELAY."""
+    while True:
+        outbox.added.clear()
+        if deliver_pending(outbox, config, session):
+            outbox.added.wait(config["delay"])
+        else:
+            time.sleep(get_breaker(config).remaining() or config["delay"])
+
+
+def deliver_pending(outbox, config, session):
+    """
+    Deliver the messages waiting in the outbox and record the action to apply
+    to each. A message the webhook fails to accept is kept in the outbox to
+    be retried, after the messages behind it, until MAX_DELIVERY_ATTEMPTS.
+    Stop when the circuit breaker opens. Return False if messages are left
+    to retry.
+    """
+    failed = set()
+    while True:
+        entries = outbox.pending(config["batch_size"], skip=failed)
+        if not entries:
+            return not failed
+        for msg_id, body in entries:
+            logger.debug("Deliver message ID %s from outbox", msg_id)
             try:
-                payload = res.json()
-            except Exception:
-                payload = None
-            if isinstance(payload, dict) and payload.get("status") == "REFUSED":
-                print(
-                    f"Message refused by webhook (reason={payload.get('reason')}); "
-                    f"moving msg id {msg_id} to {refused_folder}"
+                action = deliver_msg(msg_id, body, config, session)
+            except CircuitOpen as e:
+                logger.warning(
+                    "Unable to deliver msg, going to retry: %s",
+                    e,
+                    extra={"msg_id": msg_id},
                 )
-                client.move(msg_id, refused_folder)
-                return
-        # process real errors
-        res.raise_for_status()
-        response = res.json()
-        print("Delivered message id {} :".format(msg_id), response)
-        if config["imap"]["on_success"] == "delete":
-            client.mark_delete(msg_id)
-        elif config["imap"]["on_success"] == "move":
-            client.move(msg_id, config["imap"]["success"])
+                return False
+            except WebhookUnavailable as e:
+                attempts = outbox.failed(msg_id)
+                maximum = config["max_delivery_attempts"]
+                if not maximum or attempts < maximum:
+                    logger.warning(
+                        "Unable to deliver msg, going to retry: %s",
+                        e,
+                        extra={"msg_id": msg_id, "attempt": attempts},
+                    )
+                    failed.add(msg_id)
+                    continue
+                action = error_action(e, config)
+            except Exception as e:
+                action = error_action(e, config)
+            outbox.record(msg_id, action)
+
+
+def settle_outbox(client, outbox):
+    """
+    Apply the actions recorded for delivered messages and drop them. Messages
+    stored before UIDVALIDITY changed are dropped without applying anything,
+    since their UIDs now identify other messages.
+    """
+    stale = outbox.drop_stale(client.uidvalidity)
+    if stale:
+        logger.warning(
+            "UIDVALIDITY changed, dropping %d messages from the outbox", len(stale)
+        )
+    delivered = outbox.delivered()
+    if not delivered:
+        return
+    actions = {}
+    for msg_id, action in delivered:
+        if action:
+            actions.setdefault(action, []).append(msg_id)
+    apply_actions(client, actions)
+    client.expunge()
+    outbox.remove([msg_id for msg_id, _ in delivered])
+
+
+def serialize_msg(raw_mail, config):
+    start = time.time()
+    timings = {}
+    body = serialize_mail(
+        raw_mail, config["compress_eml"], config["spool_threshold"], timings
+    )
+    observe_stages(timings)
+    end = time.time()
+    logger.debug(
+        "Message serialized in %.3f seconds",
+        end - start,
+        extra={"seconds": end - start},
+    )
+    return body
+
+
+def deliver_msg(msg_id, body, config, session):
+    sink = get_sink(config)
+    if sink:
+        path = sink.write(config["name"], msg_id, body)
+        logger.info(
+            "Stored message id %s in %s", msg_id, path, extra={"msg_id": msg_id}
+        )
+        return success_action(msg_id, config)
+    dedup = get_dedup(config)
+    if dedup:
+        body, uploaded = dedup.prepare(body, session)
+    res = post_webhook(config, session, body)
+    log_response(res)
+    # detect structured refusal and move to REFUSED folder
+    if res.status_code >= 400:
+        refused_folder = config["imap"].get("refused", "REFUSED")
+        # parse JSON refusal marker
+        payload = None
+        try:
+            payload = res.json()
+        except Exception:
+            payload = None
+        if isinstance(payload, dict) and payload.get("status") == "REFUSED":
+            logger.info(
+                "Message refused by webhook (reason=%s); moving msg id %s to %s",
+                payload.get("reason"),
+                msg_id,
+                refused_folder,
+                extra={"msg_id": msg_id, "outcome": "refused"},
+            )
+            MESSAGES.inc(outcome="refused")
+            return "move", refused_folder
+    # process real errors
+    res.raise_for_status()
+    # a response which is not JSON is a failed delivery
+    res.json()
+    logger.info(
+        "Delivered message id %s",
+        msg_id,
+        extra={"msg_id": msg_id, "outcome": "success"},
+    )
+    if dedup:
+        dedup.remember(uploaded)
+    return success_action(msg_id, config)
+
+
+def deliver_msgs(bodies, config, session):
+    """
+    POST (msg_id, body) pairs in one batch request and map the status the
+    response reports for each message to its action.
+    """
+    dedup = get_dedup(config)
+    uploaded = set()
+    if dedup:
+        prepared = []
+        for msg_id, body in bodies:
+            body, digests = dedup.prepare(body, session)
+            prepared.append((msg_id, body))
+            uploaded.update(digests)
+        bodies = prepared
+    res = post_webhook(config, session, combine_mails(bodies))
+    log_response(res)
+    res.raise_for_status()
+    if dedup:
+        dedup.remember(uploaded)
+    results = res.json().get("results", {})
+    actions = []
+    for msg_id, _ in bodies:
+        result = results.get(msg_id, {})
+        if result.get("status") == "OK":
+            action = success_action(msg_id, config)
+        elif result.get("status") == "REFUSED":
+            logger.info(
+                "Message id %s refused by webhook (reason=%s)",
+                msg_id,
+                result.get("reason"),
+                extra={"msg_id": msg_id, "outcome": "refused"},
+            )
+            MESSAGES.inc(outcome="refused")
+            action = "move", config["imap"]["refused"]
         else:
-            print("Nothing to do for message id {}".format(msg_id))
-    except Exception as e:
-        sentry_sdk.capture_exception(e)
-        client.move(msg_id, config["imap"]["error"])
-        print("Unable to parse or delivery msg", e)
+            logger.error(
+                "Message id %s not accepted by webhook: %s",
+                msg_id,
+                result,
+                extra={"msg_id": msg_id, "outcome": "error"},
+            )
+            MESSAGES.inc(outcome="error")
+            action = "move", config["imap"]["error"]
+        actions.append((msg_id, action))
+    return actions
+
+
+def log_response(res):
+    # the response body may be large, decode it only when it is logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Received response: %.1000s",
+            res.text,
+            extra={"status": res.status_code},
+        )
+
+
+def success_action(msg_id, config):
+    MESSAGES.inc(outcome="success")
+    if config["imap"]["on_success"] == "delete":
+        return "delete", None
+    elif config["imap"]["on_success"] == "move":
+        return "move", config["imap"]["success"]
+    else:
+        logger.debug("Nothing to do for message id %s", msg_id)
+
+
+def defer_action(e, msg_id, config):
+    """
+    Return DEFER to leave a message the webhook failed to accept in the
+    mailbox, or the error action once its delivery failed
+    MAX_DELIVERY_ATTEMPTS times. Messages rejected by the open circuit
+    breaker were not sent, so they are not counted.
+    """
+    key = checkpoint_key(config), msg_id
+    if not isinstance(e, CircuitOpen):
+        deferrals[key] = deferrals.get(key, 0) + 1
+    attempts = deferrals.get(key, 0)
+    maximum = config["max_delivery_attempts"]
+    if maximum and attempts >= maximum:
+        del deferrals[key]
+        return error_action(e, config)
+    logger.warning(
+        "Leaving msg id %s to retry later: %s",
+        msg_id,
+        e,
+        extra={"msg_id": msg_id, "attempt": attempts},
+    )
+    return DEFER
+
+
+def error_action(e, config):
+    sentry_sdk.capture_exception(e)
+    MESSAGES.inc(outcome="error")
+    # logged as a warning, since sentry-sdk also reports ERROR records
+    logger.warning("Unable to parse or delivery msg: %s", e, extra={"outcome": "error"})
+    return "move", config["imap"]["error"]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import requests
+
+from delivery import RETRY_STATUSES, WebhookUnavailable
+from mail_parser import JSON_MIME
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_sha256(file):
+    file.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    size = file.tell()
+    file.seek(0)
+    return digest.hexdigest(), size
+
+
+class AttachmentDedup:
+    """
+    Uploads only the attachments the webhook does not have yet. The manifest
+    lists the SHA-256 of every attachment and the hashes not acknowledged
+    recently are checked in one request to ``DEDUP_URL``, which answers with
+    the hashes it is missing.
+    """
+
+    def __init__(self, url, cache_size):
+        self.url = url
+        self.cache_size = cache_size
+        # hashes of attachments the webhook is known to have, oldest first
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def known(self, digest):
+        with self.lock:
+            if digest not in self.cache:
+                return False
+            self.cache.move_to_end(digest)
+            return True
+
+    def remember(self, digests):
+        with self.lock:
+            for digest in digests:
+                self.cache[digest] = True
+                self.cache.move_to_end(digest)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def missing(self, session, digests):
+        """Return the hashes the webhook does not have."""
+        try:
+            res = session.post(self.url, json={"sha256": sorted(digests)})
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise WebhookUnavailable("Unable to check attachments", e) from e
+        if res.status_code in RETRY_STATUSES:
+            raise WebhookUnavailable("Unable to check attachments", res.status_code)
+        res.raise_for_status()
+        return set(res.json()["missing"])
+
+    def prepare(self, body, session):
+        """
+        Return the body with the attachments the webhook already has left out,
+        and the hashes of the uploaded attachments, to be remembered once the
+        delivery succeeds.
+        """
+        parts = []
+        attachments = []
+        manifest = None
+        for name, (filename, file, mime) in body:
+            if name == "manifest":
+                manifest = json.load(file)
+            elif name == "attachment":
+                digest, size = file_sha256(file)
+                attachments.append((digest, size, (name, (filename, file, mime))))
+            else:
+                parts.append((name, (filename, file, mime)))
+        unknown = {digest for digest, _, _ in attachments if not self.known(digest)}
+        missing = self.missing(session, unknown) if unknown else set()
+        self.remember(unknown - missing)
+        manifest["attachments"] = []
+        uploaded = set()
+        for digest, size, part in attachments:
+            upload = digest in missing and digest not in uploaded
+            manifest["attachments"].append(
+                {
+                    "filename": part[1][0],
+                    "sha256": digest,
+                    "size": size,
+                    "uploaded": upload,
+                }
+            )
+            if upload:
+                parts.append(part)
+                uploaded.add(digest)
+        content = BytesIO(json.dumps(manifest).encode("utf-8"))
+        return [("manifest", ("manifest.json", content, JSON_MIME))] + parts, uploaded
+
+
+# one cache per webhook URL, shared by the mailboxes posting to it
+dedups = {}
+
+
+def get_dedup(config):
+    """Return the AttachmentDedup of the webhook, None if DEDUP_URL is not set."""
+    if not config["dedup_url"]:
+        return None
+    if config["webhook"] not in dedups:
+        dedups[config["webhook"]] = AttachmentDedup(
+            config["dedup_url"], config["dedup_cache_size"]
+        )
+    return dedups[config["webhook"]]
@@ -0,0 +1,311 @@
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import BYTES, CONCURRENCY_LIMIT, STAGE_SECONDS
+from multipart import MultipartStream
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# action of a message left in the mailbox until the webhook recovers
+DEFER = ("defer", None)
+
+
+class WebhookUnavailable(Exception):
+    """The webhook failed with a transient error, retry the message later."""
+
+
+class CircuitOpen(WebhookUnavailable):
+    """The circuit breaker is open, the message was not sent to the webhook."""
+
+
+class CircuitBreaker:
+    """
+    Opens after ``threshold`` consecutive failed requests and rejects requests
+    for ``timeout`` seconds, then lets one request through to probe whether
+    the webhook recovered.
+    """
+
+    def __init__(self, threshold, timeout):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        """Return the seconds left until the next probe, 0 if not open."""
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(self.opened_at + self.timeout - time.monotonic(), 0)
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() < self.opened_at + self.timeout:
+                return False
+            # let this request probe the webhook and hold back the others
+            self.opened_at = time.monotonic()
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Webhook recovered, resuming deliveries")
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.threshold:
+                return
+            if self.opened_at is None:
+                logger.warning(
+                    "Webhook failed %d times, pausing deliveries for %s seconds",
+                    self.failures,
+                    self.timeout,
+                )
+            self.opened_at = time.monotonic()
+
+
+class ConcurrencyLimiter:
+    """
+    Limits the requests in flight to the webhook with AIMD, as TCP congestion
+    control does: the limit grows by one request per ``limit`` requests while
+    the p95 latency of the last ``window`` requests stays under
+    ``target_latency``, and is halved on a 429 or 503 response, a connection
+    error or a p95 latency above the target.
+    """
+
+    def __init__(self, maximum, target_latency, window=20, minimum=1, name=""):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.limit = float(minimum)
+        self.inflight = 0
+        self.latencies = deque(maxlen=window)
+        self.condition = threading.Condition()
+        CONCURRENCY_LIMIT.set(int(self.limit), webhook=name)
+
+    def acquire(self):
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                self.condition.wait()
+            self.inflight += 1
+
+    def release(self, latency, overloaded=False):
+        with self.condition:
+            self.inflight -= 1
+            previous = int(self.limit)
+            self.latencies.append(latency)
+            if overloaded or self.p95() > self.target_latency:
+                self.limit = max(self.limit / 2, self.minimum)
+                # judge the new limit on latencies measured under it
+                self.latencies.clear()
+            elif len(self.latencies) == self.latencies.maxlen:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            if int(self.limit) != previous:
+                logger.info("Webhook concurrency limit set to %d", int(self.limit))
+                CONCURRENCY_LIMIT.set(int(self.limit), webhook=self.name)
+            self.condition.notify_all()
+
+    def p95(self):
+        if len(self.latencies) < self.latencies.maxlen:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[math.ceil(len(latencies) * 0.95) - 1]
+
+
+# one circuit breaker and limiter per webhook URL, shared by the mailboxes
+# posting to it
+breakers = {}
+limiters = {}
+
+
+def get_breaker(config):
+    if config["webhook"] not in breakers:
+        breakers[config["webhook"]] = CircuitBreaker(
+            config["breaker_threshold"], config["breaker_timeout"]
+        )
+    return breakers[config["webhook"]]
+
+
+def get_limiter(config):
+    """Return the limiter of the webhook, None without ADAPTIVE_CONCURRENCY."""
+    if not config["adaptive_concurrency"]:
+        return None
+    if config["webhook"] not in limiters:
+        limiters[config["webhook"]] = ConcurrencyLimiter(
+            config["delivery_concurrency"],
+            config["target_latency"],
+            name=urlparse(config["webhook"]).hostname or "",
+        )
+    return limiters[config["webhook"]]
+
+
+def retry_after(res):
+    """Return the delay requested by a Retry-After header in seconds, or None."""
+    value = res.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def backoff(attempt, config):
+    # exponential backoff with full jitter spreads retries of several daemons
+    delay = min(config["retry_delay"] * 2**attempt, config["retry_max_delay"])
+    return random.uniform(0, delay)
+
+
+def post_webhook(config, session, body):
+    """
+    POST a message to the webhook, retrying connection errors and 429 or 5xx
+    responses after the Retry-After delay or an exponential backoff. Raise
+    WebhookUnavailable once retries are exhausted or the circuit breaker
+    is open.
+    """
+    breaker = get_breaker(config)
+    for attempt in range(config["delivery_retries"] + 1):
+        if not breaker.allow():
+            raise CircuitOpen("Circuit breaker is open")
+        for _, (_, file, _) in body:
+            file.seek(0)
+        try:
+            res = limited_send(config, session, body)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error, delay = e, None
+        else:
+            if res.status_code not in RETRY_STATUSES:
+                breaker.success()
+                return res
+            error, delay = "HTTP {}".format(res.status_code), retry_after(res)
+        breaker.failure()
+        if attempt == config["delivery_retries"]:
+            break
+        if delay is None:
+            delay = backoff(attempt, config)
+        delay = min(delay, config["retry_max_delay"])
+        logger.warning(
+            "Delivery failed (%s), retrying in %.1f seconds",
+            error,
+            delay,
+            extra={"attempt": attempt + 1},
+        )
+        time.sleep(delay)
+    raise WebhookUnavailable("Webhook unavailable", error)
+
+
+def limited_send(config, session, body):
+    limiter = get_limiter(config)
+    if limiter is None:
+        return send(config, session, body)
+    limiter.acquire()
+    start = time.monotonic()
+    overloaded = True
+    try:
+        res = send(config, session, body)
+        overloaded = res.status_code in (429, 503)
+        return res
+    finally:
+        limiter.release(time.monotonic() - start, overloaded)
+
+
+def send(config, session, body):
+    with STAGE_SECONDS.time(stage="post"):
+        if not config["http"]["stream_upload"]:
+            res = session.post(config["webhook"], files=body)
+        else:
+            stream = MultipartStream(body)
+            res = session.post(
+                config["webhook"],
+                data=stream,
+                headers={"Content-Type": stream.content_type},
+            )
+    size = sum(MultipartStream.size(file) for _, (_, file, _) in body)
+    BYTES.inc(size, direction="out")
+    return res
+
+
+class WebhookSession(requests.Session):
+    """requests session applying the configured timeout to every request."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+class HTTP2Session:
+    """
+    httpx client multiplexing concurrent requests to a host over one HTTP/2
+    connection, raising the requests exceptions handled by post_webhook.
+    """
+
+    def __init__(self, client, httpx):
+        self.client = client
+        self.httpx = httpx
+
+    def post(self, url, files=None, data=None, headers=None, json=None):
+        try:
+            if json is not None:
+                return self.client.post(url, json=json)
+            if data is not None:
+                headers = {**headers, "Content-Length": str(len(data))}
+                return self.client.post(url, content=iter(data), headers=headers)
+            return self.client.post(url, files=files)
+        except self.httpx.TimeoutException as e:
+            raise requests.Timeout(e) from e
+        except self.httpx.TransportError as e:
+            raise requests.ConnectionError(e) from e
+
+
+def new_session(config):
+    """Return the HTTP session used to deliver messages to the webhook."""
+    http = config["http"]
+    if http["http2"]:
+        try:
+            import httpx
+        except ImportError as e:
+            raise Exception("HTTP2 requires the httpx[http2] package") from e
+        client = httpx.Client(
+            http2=True,
+            timeout=httpx.Timeout(
+                http["read_timeout"], connect=http["connect_timeout"]
+            ),
+            limits=httpx.Limits(
+                max_connections=http["pool_size"],
+                max_keepalive_connections=http["pool_size"] if http["keepalive"] else 0,
+            ),
+        )
+        return HTTP2Session(client, httpx)
+    session = WebhookSession((http["connect_timeout"], http["read_timeout"]))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http["pool_size"])
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not http["keepalive"]:
+        session.headers["Connection"] = "close"
+    return session
@@ -0,0 +1,189 @@
+import concurrent.futures
+import json
+import logging
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from mail_parser import serialize_mail
+from metrics import observe_stages
+
+logger = logging.getLogger(__name__)
+
+PARSE_EXECUTORS = ("inline", "thread", "process", "interpreter")
+
+PROBE_MAIL = (
+    b"From: probe@example.com\r\n"
+    b"To: probe@example.com\r\n"
+    b"Subject: probe\r\n"
+    b"Content-Type: text/html; charset=utf-8\r\n"
+    b"\r\n"
+    b"<p>Reply</p><blockquote>On Mon, Bob wrote:<p>Quote</p></blockquote>\r\n"
+)
+
+
+def serialize_parts(raw_mail, compress_eml):
+    """
+    Run serialize_mail in a worker process or interpreter, returning the content
+    of the parts as bytes since file objects can not be sent back, and the
+    stage timings, since metrics recorded in the worker are not served.
+    """
+    timings = {}
+    parts = [
+        (name, (filename, file.read(), mime))
+        for name, (filename, file, mime) in serialize_mail(
+            raw_mail, compress_eml, timings=timings
+        )
+    ]
+    return parts, timings
+
+
+def serialize_timed(raw_mail, compress_eml, spool_threshold):
+    timings = {}
+    return serialize_mail(raw_mail, compress_eml, spool_threshold, timings), timings
+
+
+def as_files(result):
+    parts, timings = result
+    observe_stages(timings)
+    return [
+        (name, (filename, BytesIO(content), mime))
+        for name, (filename, content, mime) in parts
+    ]
+
+
+def get_parse_executor(config):
+    """Return the ParseExecutor selected by PARSE_EXECUTOR, None to parse inline."""
+    if config["parse_executor"] not in PARSE_EXECUTORS:
+        raise Exception("Unknown parse executor", config["parse_executor"])
+    if config["parse_executor"] == "inline":
+        return None
+    return ParseExecutor(config)
+
+
+class ParseExecutor:
+    """
+    Runs serialize_mail for fetched messages in PARSE_WORKERS threads, processes
+    or interpreters, while the IMAP connection and the HTTP session stay in the
+    daemon's main thread.
+    """
+
+    def __init__(self, config):
+        self.kind = config["parse_executor"]
+        self.compress_eml = config["compress_eml"]
+        self.spool_threshold = config["spool_threshold"]
+        self.workers = config["parse_workers"]
+        self.pool = self._new_pool()
+        if self.kind in ("thread", "interpreter"):
+            self.validate()
+
+    def _new_pool(self):
+        if self.kind == "thread":
+            if getattr(sys, "_is_gil_enabled", lambda: True)():
+                logger.warning(
+                    "Parse threads share the GIL, consider a free-threaded build"
+                )
+            return ThreadPoolExecutor(self.workers, thread_name_prefix="parse")
+        if self.kind == "interpreter":
+            if not hasattr(concurrent.futures, "InterpreterPoolExecutor"):
+                raise Exception("Parse executor 'interpreter' requires Python 3.14")
+            return concurrent.futures.InterpreterPoolExecutor(self.workers)
+        return ProcessPoolExecutor(self.workers)
+
+    def validate(self):
+        """
+        Parse a probe message in every worker at once and compare the manifests
+        with an inline parse, so that extension modules which can not be loaded
+        in sub-interpreters or module-level state shared by threads fail fast.
+        """
+        expected = self._manifest(serialize_mail(PROBE_MAIL, self.compress_eml))
+        tasks = [self.submit(PROBE_MAIL) for _ in range(2 * self.workers)]
+        for task in tasks:
+            try:
+                manifest = self._manifest(task.result())
+            except Exception as e:
+                self.shutdown()
+                raise Exception(
+                    "Parse executor '{}' can not run serialize_mail".format(self.kind)
+                ) from e
+            if manifest != expected:
+                self.shutdown()
+                raise Exception(
+                    "Parse executor '{}' returned an inconsistent result".format(
+                        self.kind
+                    ),
+                    manifest,
+                )
+
+    @staticmethod
+    def _manifest(body):
+        return json.loads(dict(body)["manifest"][1].read())
+
+    def submit(self, raw_mail):
+        if self.kind == "thread":
+            future = self.pool.submit(
+                serialize_timed, raw_mail, self.compress_eml, self.spool_threshold
+            )
+            return ParseTask(self, self.pool, raw_mail, future)
+        if not isinstance(raw_mail, bytes):
+            raw_mail = raw_mail.read()
+        pool = self.pool
+        try:
+            future = pool.submit(serialize_parts, raw_mail, self.compress_eml)
+        except BrokenProcessPool:
+            # a worker crashed on a message submitted before this one
+            self.restart(pool)
+            pool = self.pool
+            future = pool.submit(serialize_parts, raw_mail, self.compress_eml)
+        return ParseTask(self, pool, raw_mail, future)
+
+    def parse_ahead(self, messages):
+        """
+        Submit (msg_id, raw_mail) pairs ahead of their consumer and yield
+        (msg_id, raw_mail, task) in the original order.
+        """
+        window = deque()
+        for msg_id, raw_mail in messages:
+            window.append((msg_id, raw_mail, self.submit(raw_mail)))
+            if len(window) >= 2 * self.workers:
+                yield window.popleft()
+        while window:
+            yield window.popleft()
+
+    def restart(self, broken_pool):
+        if self.pool is broken_pool:
+            self.pool.shutdown(wait=False)
+            self.pool = self._new_pool()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class ParseTask:
+    def __init__(self, executor, pool, raw_mail, future):
+        self.executor = executor
+        self.pool = pool
+        self.raw_mail = raw_mail
+        self.future = future
+
+    def result(self):
+        if self.executor.kind == "thread":
+            body, timings = self.future.result()
+            observe_stages(timings)
+            return body
+        try:
+            return as_files(self.future.result())
+        except BrokenProcessPool:
+            logger.warning(
+                "Parse worker crashed, going to parse the message again alone"
+            )
+            self.executor.restart(self.pool)
+        # A crashed worker breaks every task pending in its pool, so parse the
+        # message in a pool of its own to tell whether it caused the crash.
+        with ProcessPoolExecutor(1) as pool:
+            future = pool.submit(
+                serialize_parts, self.raw_mail, self.executor.compress_eml
+            )
+            return as_files(future.result())
@@ -0,0 +1,108 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# attributes of every LogRecord, anything else was passed with ``extra``
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the fields passed in ``extra``."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = {k: v for k, v in vars(record).items() if k not in RECORD_ATTRIBUTES}
+        if fields:
+            line += " " + " ".join("{}={}".format(k, v) for k, v in fields.items())
+        return line
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most ``rate`` records per second from each logging call,
+    with bursts of as many, counting the dropped ones in ``suppressed`` of the
+    next record let through. Errors are never dropped.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        # (tokens, last refill, dropped records) per call site
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate or record.levelno >= logging.ERROR:
+            return True
+        site = record.pathname, record.lineno
+        now = time.monotonic()
+        with self.lock:
+            tokens, last, dropped = self.buckets.get(site, (self.rate, now, 0))
+            tokens = min(tokens + (now - last) * self.rate, self.rate)
+            if tokens < 1:
+                self.buckets[site] = tokens, now, dropped + 1
+                return False
+            self.buckets[site] = tokens - 1, now, 0
+        if dropped:
+            record.suppressed = dropped
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler dropping records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(config, stream=None):
+    """
+    Route log records through a bounded queue to a listener thread writing
+    them to stderr, so that logging never blocks the message path. Return
+    the listener, stopped to flush the queue.
+    """
+    if config["log_format"] not in ("json", "text"):
+        raise Exception("Unknown log format", config["log_format"])
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if config["log_format"] == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(message)s"))
+    log_queue = queue.Queue(config["log_queue_size"])
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(config["log_rate_limit"]))
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(config["log_level"])
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
@@ -2,8 +2,11 @@ import base64
 import binascii
 import gzip
 import json
+import os
 import quopri
 import re
+import shutil
+import time
 import uuid
 from email import policy
 from email.header import Header as EmailHeader
@@ -11,6 +14,7 @@ from email.parser import BytesParser
 from email.policy import compat32
 from email.utils import getaddresses
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 
 import mailparser
 from email_validator import validate_email
@@ -32,8 +36,12 @@ decoder_map = {
 
 JSON_MIME = "application/json"
 GZ_MIME = "application/gzip"
+ZSTD_MIME = "application/zstd"
+NDJSON_MIME = "application/x-ndjson"
 EML_MIME = "message/rfc822"
 BINARY_MIME = "application/octet-stream"
+EML_CODECS = {"gzip": ("eml.gz", GZ_MIME), "zstd": ("eml.zst", ZSTD_MIME)}
+COMPRESSION_SAMPLE_SIZE = 16 * 1024
 _BASIC_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+$")  # intentionally permissive
 
 
@@ -173,7 +181,17 @@ def get_to_plus(mail):
     return list(to_plus)
 
 
-def get_attachments(mail):
+def new_buffer(spool_threshold=None):
+    """
+    Return an in-memory buffer, or a temporary file which spills to disk once it
+    grows over ``spool_threshold`` bytes.
+    """
+    if spool_threshold:
+        return SpooledTemporaryFile(max_size=spool_threshold)
+    return BytesIO()
+
+
+def get_attachments(mail, spool_threshold=None):
     attachments = []
     for attachment in mail.attachments:
         if attachment["content_transfer_encoding"] not in decoder_map:
@@ -186,8 +204,10 @@ def get_attachments(mail):
         filename = attachment["filename"]
 
         try:
-            content = decoder(attachment["payload"])
-            attachments.append((filename, BytesIO(content), BINARY_MIME))
+            file = new_buffer(spool_threshold)
+            file.write(decoder(attachment["payload"]))
+            file.seek(0)
+            attachments.append((filename, file, BINARY_MIME))
         except (binascii.Error, ValueError):
             print(
                 "Unable to parse attachment '{}' in {} \n".format(
@@ -197,15 +217,76 @@ def get_attachments(mail):
     return attachments
 
 
-def get_eml(raw_mail, compress_eml):
-    content = raw_mail
+def eml_compression(compress_eml):
+    """
+    Return the options of ``compress_eml``, which is either a dict with the
+    codec, level and skip_ratio or True for gzip at its default level.
+    """
+    if compress_eml is True:
+        return {"codec": "gzip", "level": None, "skip_ratio": None}
+    return compress_eml or None
+
+
+def open_compressor(file, codec="gzip", level=None):
+    """Return a file compressing the data written to it into ``file``."""
+    if codec == "gzip":
+        return gzip.GzipFile(
+            fileobj=file, mode="wb", compresslevel=9 if level is None else level
+        )
+    if codec == "zstd":
+        try:
+            from compression import zstd
+        except ImportError:
+            import zstandard
+
+            compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+            return compressor.stream_writer(file, closefd=False)
+        return zstd.ZstdFile(file, "wb", level=level)
+    raise Exception("Unknown EML codec", codec)
 
-    if compress_eml:
-        file = BytesIO()
-        with gzip.open(file, "wb") as f:
-            f.write(raw_mail)
-        content = file.getvalue()
-    return content
+
+def is_compressible(eml_file, options, sample_size=COMPRESSION_SAMPLE_SIZE):
+    """
+    Compress samples from the start, middle and end of a message and tell
+    whether they shrink below ``skip_ratio`` of their size, which messages
+    made mostly of base64 encoded PDFs or images do not.
+    """
+    if not options["skip_ratio"]:
+        return True
+    size = eml_file.seek(0, os.SEEK_END)
+    offsets = [0, (size - sample_size) // 2, size - sample_size]
+    if size <= 3 * sample_size:
+        offsets, sample_size = [0], size
+    sample = b""
+    for offset in offsets:
+        eml_file.seek(offset)
+        sample += eml_file.read(sample_size)
+    eml_file.seek(0)
+    if not sample:
+        return True
+    compressed = BytesIO()
+    with open_compressor(compressed, options["codec"], options["level"]) as f:
+        f.write(sample)
+    return len(compressed.getvalue()) <= options["skip_ratio"] * len(sample)
+
+
+def get_eml_file(eml_file, compress_eml, spool_threshold=None, timings=None):
+    """
+    Return the eml part, compressed as it is written unless compression is
+    disabled or would not pay off, and its codec or None if not compressed.
+    The compression time is stored in ``timings["compress"]``.
+    """
+    options = eml_compression(compress_eml)
+    if not options or not is_compressible(eml_file, options):
+        return eml_file, None
+    file = new_buffer(spool_threshold)
+    start = time.monotonic()
+    with open_compressor(file, options["codec"], options["level"]) as f:
+        shutil.copyfileobj(eml_file, f)
+    if timings is not None:
+        timings["compress"] = time.monotonic() - start
+    file.seek(0)
+    return file, options["codec"]
 
 
 def _has_any_email(x) -> bool:
@@ -235,7 +316,7 @@ def _pick_addresses(*candidates):
     return None
 
 
-def get_manifest(mail, compress_eml):
+def get_manifest(mail, codec=None):
     from_source = _pick_addresses(
         getattr(mail, "_from", None),  # prefer _from
         getattr(mail, "from_", None),  # then from_
@@ -259,7 +340,8 @@ def get_manifest(mail, compress_eml):
         "text": get_text(mail),
         "files_count": len(mail.attachments),
         "eml": {
-            "compressed": compress_eml,
+            "compressed": bool(codec),
+            "codec": codec or None,
         },
     }
 
@@ -382,36 +464,70 @@ def parse_mail_from_bytes(raw_bytes):
     return mp
 
 
-def serialize_mail(raw_mail, compress_eml=False):
+def serialize_mail(raw_mail, compress_eml=False, spool_threshold=None, timings=None):
+    """
+    Build the multipart body for a message given as bytes or a binary file.
+    A file is sent as the eml part without copying it, and with
+    ``spool_threshold`` attachments and the compressed eml larger than that
+    many bytes are kept in temporary files instead of memory. ``timings``
+    receives the seconds spent in the ``parse`` and ``compress`` stages.
+    """
+    if isinstance(raw_mail, bytes):
+        eml_file = BytesIO(raw_mail)
+    else:
+        eml_file = raw_mail
+        raw_mail = eml_file.read()
+        eml_file.seek(0)
+    start = time.monotonic()
     mail = parse_mail_from_bytes(raw_mail)
+    if timings is not None:
+        timings["parse"] = time.monotonic() - start
+    del raw_mail
     files = []
+    # Build eml, first to report in the manifest whether it was compressed
+    eml, codec = get_eml_file(eml_file, compress_eml, spool_threshold, timings)
+    eml_ext, eml_mime = EML_CODECS[codec] if codec else ("eml", EML_MIME)
+    eml_name = "{}.{}".format(uuid.uuid4().hex, eml_ext)
     # Build manifest
-    body = get_manifest(mail, compress_eml)
+    body = get_manifest(mail, codec)
     files.append(
         (
             "manifest",
             ("manifest.json", BytesIO(json.dumps(body).encode("utf-8")), JSON_MIME),
         )
     )
-    # Build eml
-    eml_ext = "eml.gz" if compress_eml else "eml"
-    eml_name = "{}.{}".format(uuid.uuid4().hex, eml_ext)
-    eml_mime = GZ_MIME if compress_eml else EML_MIME
-
-    files.append(
-        ("eml", (eml_name, BytesIO(get_eml(raw_mail, compress_eml)), eml_mime))
-    )
+    files.append(("eml", (eml_name, eml, eml_mime)))
     # Build attachments
-    for att in get_attachments(mail):
+    for att in get_attachments(mail, spool_threshold):
         files.append(("attachment", att))
     return files
 
 
+def combine_mails(bodies):
+    """
+    Build the body of a batch request from (msg_id, body) pairs of serialized
+    messages: their manifests as NDJSON lines, each with the ``id`` of its
+    message, followed by the eml and attachment parts of every message named
+    ``eml_<id>`` and ``attachment_<id>``.
+    """
+    manifests = BytesIO()
+    files = [("manifests", ("manifests.ndjson", manifests, NDJSON_MIME))]
+    for msg_id, body in bodies:
+        for name, (filename, file, mime) in body:
+            if name == "manifest":
+                manifest = {"id": msg_id, **json.load(file)}
+                manifests.write(json.dumps(manifest).encode("utf-8") + b"\n")
+            else:
+                files.append(("{}_{}".format(name, msg_id), (filename, file, mime)))
+    manifests.seek(0)
+    return files
+
+
 if __name__ == "__main__":
     import sys
 
     with open(sys.argv[1], "rb") as fp:
         raw_mail = fp.read()
         mail = parse_mail_from_bytes(raw_mail)
-        body = get_manifest(mail, False)
+        body = get_manifest(mail)
         json.dump(body, sys.stdout, indent=4)
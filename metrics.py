@@ -0,0 +1,184 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in labels
+    )
+    return (
+        "{" + ",".join('{}="{}"'.format(name, value) for name, value in escaped) + "}"
+    )
+
+
+class Metric:
+    """Values of a metric per label set, rendered in the Prometheus text format."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Expected labels {}".format(self.labelnames), labels)
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines += self.samples(key, value)
+        return lines
+
+    def samples(self, key, value):
+        return ["{}{} {}".format(self.name, format_labels(key), format_value(value))]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = counts, total + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self, key, value):
+        counts, total = value
+        lines = [
+            "{}_bucket{} {}".format(
+                self.name, format_labels(key + (("le", format_value(bound)),)), count
+            )
+            for bound, count in zip(self.buckets, counts)
+        ]
+        lines.append("{}_sum{} {}".format(self.name, format_labels(key), total))
+        lines.append("{}_count{} {}".format(self.name, format_labels(key), counts[-1]))
+        return lines
+
+
+registry = []
+
+STAGE_SECONDS = Histogram(
+    "imap_to_webhook_stage_seconds",
+    "Duration of IMAP connect, fetch and move, parse, compress and post stages.",
+    ["stage"],
+)
+MESSAGES = Counter(
+    "imap_to_webhook_messages_total",
+    "Processed messages by outcome: success, refused or error.",
+    ["outcome"],
+)
+BYTES = Counter(
+    "imap_to_webhook_bytes_total",
+    "Bytes of messages fetched from IMAP (in) and posted to the webhook (out).",
+    ["direction"],
+)
+BACKLOG = Gauge(
+    "imap_to_webhook_backlog",
+    "Messages of the last search of the mailbox which are still to be processed.",
+    ["mailbox"],
+)
+CONCURRENCY_LIMIT = Gauge(
+    "imap_to_webhook_concurrency_limit",
+    "Requests allowed in flight to the webhook by ADAPTIVE_CONCURRENCY.",
+    ["webhook"],
+)
+
+
+def observe_stages(timings):
+    """Record the {stage: seconds} timings reported by serialize_mail."""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        content = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the daemon's output
+        pass
+
+
+def start_server(port, host=""):
+    """Serve /metrics from a background thread, return the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on port %d", server.server_address[1])
+    return server
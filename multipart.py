@@ -0,0 +1,63 @@
+import os
+import uuid
+
+from urllib3.fields import RequestField
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartStream:
+    """
+    multipart/form-data encoding of ``serialize_mail`` parts read lazily from
+    their files, so that a message is sent without being encoded in memory.
+    The parts are seekable files, so the length is known up front and the body
+    is streamed with a Content-Length.
+    """
+
+    def __init__(self, body, chunk_size=CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(self.boundary)
+        self.chunk_size = chunk_size
+        self.segments = []
+        for name, (filename, file, mime) in body:
+            field = RequestField(name, b"", filename=filename)
+            field.make_multipart(content_type=mime)
+            header = "--{}\r\n{}".format(self.boundary, field.render_headers())
+            self.segments += [header.encode("utf-8"), file, b"\r\n"]
+        self.segments.append("--{}--\r\n".format(self.boundary).encode())
+        self.length = sum(self.size(segment) for segment in self.segments)
+        self.chunks = None
+        self.buffer = b""
+
+    @staticmethod
+    def size(segment):
+        if isinstance(segment, bytes):
+            return len(segment)
+        size = segment.seek(0, os.SEEK_END)
+        segment.seek(0)
+        return size
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            segment.seek(0)
+            while chunk := segment.read(self.chunk_size):
+                yield chunk
+
+    def read(self, size=-1):
+        if self.chunks is None:
+            self.chunks = iter(self)
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
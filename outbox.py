@@ -0,0 +1,176 @@
+import sqlite3
+import threading
+from io import BytesIO
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    mailbox TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    action TEXT,
+    folder TEXT,
+    uidvalidity INTEGER,
+    PRIMARY KEY (mailbox, uid)
+);
+CREATE TABLE IF NOT EXISTS parts (
+    mailbox TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    content BLOB NOT NULL,
+    mime TEXT NOT NULL,
+    PRIMARY KEY (mailbox, uid, position)
+);
+"""
+
+
+class Outbox:
+    """
+    Serialized messages waiting for delivery, stored in an SQLite database
+    shared by all mailboxes and keyed by ``checkpoint_key``. A message stays
+    in the outbox until the action recorded after its delivery is applied.
+    The UIDVALIDITY of the mailbox is stored with each message, since its
+    UID identifies another message once UIDVALIDITY changes.
+    """
+
+    def __init__(self, path, key):
+        self.key = key
+        # the delivery thread and the IMAP loop share the connection
+        self.lock = threading.Lock()
+        self.added = threading.Event()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(messages)")}
+            if "uidvalidity" not in columns:
+                self.db.execute("ALTER TABLE messages ADD COLUMN uidvalidity INTEGER")
+
+    def add(self, msg_id, body, uidvalidity):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO messages (mailbox, uid, uidvalidity) "
+                "VALUES (?, ?, ?)",
+                (self.key, msg_id, uidvalidity),
+            )
+            self.db.execute(
+                "DELETE FROM parts WHERE mailbox = ? AND uid = ?", (self.key, msg_id)
+            )
+            self.db.executemany(
+                "INSERT INTO parts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (self.key, msg_id, position, name, filename, file.read(), mime)
+                    for position, (name, (filename, file, mime)) in enumerate(body)
+                ],
+            )
+        self.added.set()
+
+    def drop_stale(self, uidvalidity):
+        """Remove the messages stored under another UIDVALIDITY, return UIDs."""
+        with self.lock:
+            msg_ids = [
+                uid
+                for uid, in self.db.execute(
+                    "SELECT uid FROM messages WHERE mailbox = ? "
+                    "AND uidvalidity IS NOT ?",
+                    (self.key, uidvalidity),
+                )
+            ]
+        self.remove(msg_ids)
+        return msg_ids
+
+    def known(self, msg_ids):
+        """Return the UIDs of ``msg_ids`` already stored in the outbox."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT uid FROM messages WHERE mailbox = ?", (self.key,)
+            ).fetchall()
+        return {uid for uid, in rows}.intersection(msg_ids)
+
+    def backlog(self):
+        """Return the number of messages not removed from the outbox yet."""
+        with self.lock:
+            (count,) = self.db.execute(
+                "SELECT COUNT(*) FROM messages WHERE mailbox = ?", (self.key,)
+            ).fetchone()
+        return count
+
+    def pending(self, limit=None, skip=()):
+        """
+        Return [(msg_id, body)] of undelivered messages, oldest first, leaving
+        out the UIDs in ``skip``.
+        """
+        with self.lock:
+            msg_ids = [
+                uid
+                for uid, in self.db.execute(
+                    "SELECT uid FROM messages WHERE mailbox = ? AND NOT delivered "
+                    "ORDER BY rowid",
+                    (self.key,),
+                )
+                if uid not in skip
+            ][:limit]
+            return [(msg_id, self._body(msg_id)) for msg_id in msg_ids]
+
+    def _body(self, msg_id):
+        rows = self.db.execute(
+            "SELECT name, filename, content, mime FROM parts "
+            "WHERE mailbox = ? AND uid = ? ORDER BY position",
+            (self.key, msg_id),
+        )
+        return [
+            (name, (filename, BytesIO(content), mime))
+            for name, filename, content, mime in rows
+        ]
+
+    def record(self, msg_id, action):
+        """Record the action to apply to a delivered message, dropping its body."""
+        action, folder = action or (None, None)
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE messages SET delivered = 1, action = ?, folder = ? "
+                "WHERE mailbox = ? AND uid = ?",
+                (action, folder, self.key, msg_id),
+            )
+            self.db.execute(
+                "DELETE FROM parts WHERE mailbox = ? AND uid = ?", (self.key, msg_id)
+            )
+
+    def failed(self, msg_id):
+        """Count a failed delivery of a message, return its failed deliveries."""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE messages SET attempts = attempts + 1 "
+                "WHERE mailbox = ? AND uid = ?",
+                (self.key, msg_id),
+            )
+            (attempts,) = self.db.execute(
+                "SELECT attempts FROM messages WHERE mailbox = ? AND uid = ?",
+                (self.key, msg_id),
+            ).fetchone()
+        return attempts
+
+    def delivered(self):
+        """Return [(msg_id, action)] of delivered messages."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT uid, action, folder FROM messages "
+                "WHERE mailbox = ? AND delivered ORDER BY rowid",
+                (self.key,),
+            ).fetchall()
+        return [
+            (msg_id, (action, folder) if action else None)
+            for msg_id, action, folder in rows
+        ]
+
+    def remove(self, msg_ids):
+        with self.lock, self.db:
+            self.db.executemany(
+                "DELETE FROM messages WHERE mailbox = ? AND uid = ?",
+                [(self.key, msg_id) for msg_id in msg_ids],
+            )
+            self.db.executemany(
+                "DELETE FROM parts WHERE mailbox = ? AND uid = ?",
+                [(self.key, msg_id) for msg_id in msg_ids],
+            )
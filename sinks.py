@@ -0,0 +1,86 @@
+import base64
+import json
+import os
+import re
+import shutil
+import threading
+
+
+def safe_filename(filename):
+    return re.sub(r"[^\w.-]", "_", os.path.basename(filename or "")) or "part"
+
+
+class DirectorySink:
+    """
+    Writes each message to ``<path>/<mailbox>/<uid>/``: the ``manifest.json``
+    of ``serialize_mail`` next to its eml and attachment files, numbered in
+    the order of the request parts. The directory is renamed into place once
+    complete, so a loader never sees a partly written message.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, mailbox, msg_id, body):
+        target = os.path.join(self.path, mailbox, msg_id)
+        tmp = os.path.join(self.path, mailbox, ".{}.tmp".format(msg_id))
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for position, (name, (filename, file, _)) in enumerate(body):
+            if name != "manifest":
+                filename = "{}-{}".format(position, safe_filename(filename))
+            file.seek(0)
+            with open(os.path.join(tmp, filename), "wb") as fp:
+                shutil.copyfileobj(file, fp)
+        # a message searched again after a UIDVALIDITY change replaces the old one
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(tmp, target)
+        return target
+
+
+class JSONLSink:
+    """
+    Appends each message to one NDJSON file as its manifest extended with the
+    ``mailbox``, the ``id`` (UID) and the ``parts`` of the request, their
+    content base64 encoded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # mailboxes and delivery threads append to the same file
+        self.lock = threading.Lock()
+
+    def write(self, mailbox, msg_id, body):
+        message = {"mailbox": mailbox, "id": msg_id, "parts": []}
+        for name, (filename, file, mime) in body:
+            file.seek(0)
+            if name == "manifest":
+                message.update(json.load(file))
+                continue
+            message["parts"].append(
+                {
+                    "name": name,
+                    "filename": filename,
+                    "content_type": mime,
+                    "content": base64.b64encode(file.read()).decode("ascii"),
+                }
+            )
+        line = json.dumps(message).encode("utf-8") + b"\n"
+        with self.lock, open(self.path, "ab") as fp:
+            fp.write(line)
+        return self.path
+
+
+# one sink per path, shared by the mailboxes writing to it
+sinks = {}
+
+
+def get_sink(config):
+    """Return the sink of the mailbox, None to deliver to the webhook."""
+    if config["sink"] == "webhook":
+        return None
+    key = config["sink"], config["sink_path"]
+    if key not in sinks:
+        sink_class = DirectorySink if config["sink"] == "directory" else JSONLSink
+        sinks[key] = sink_class(config["sink_path"])
+    return sinks[key]